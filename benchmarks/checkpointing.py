@@ -0,0 +1,117 @@
+import argparse
+import multiprocessing
+
+import torch
+
+from benchmarks.loss_functions import peak_rss_mb
+from models import unet
+
+MODELS = {'unet': unet.UNet, 'unetsmall': unet.UNetSmall}
+
+
+def training_step(model, batch_size, args, device):
+    """Forward and backward pass of a random batch"""
+    inputs = torch.randn(batch_size, args.bands, args.samples_size, args.samples_size, device=device)
+    labels = torch.randint(0, args.num_classes, (batch_size, args.samples_size, args.samples_size), device=device)
+    torch.nn.functional.cross_entropy(model(inputs), labels).backward()
+    model.zero_grad(set_to_none=True)
+
+
+def check_batch_norm_stats(args, device):
+    """Checkpointed stages must update the batch norm running statistics once per step, as without checkpointing"""
+    torch.manual_seed(0)
+    inputs = torch.randn(2, args.bands, 64, 64, device=device)
+    labels = torch.randint(0, args.num_classes, (2, 64, 64), device=device)
+    buffers = []
+    for checkpoint_stages in [None, 'all']:
+        torch.manual_seed(0)
+        model = unet.UNetSmall(args.num_classes, args.bands, checkpoint_stages=checkpoint_stages).to(device).train()
+        torch.nn.functional.cross_entropy(model(inputs), labels).backward()
+        buffers.append(dict(model.named_buffers()))
+    for name, buffer in buffers[0].items():
+        assert torch.allclose(buffer, buffers[1][name], rtol=1e-4, atol=1e-6), f'{name} differs with checkpointing'
+    print('checkpointed stages update the batch norm statistics once per step')
+
+
+def fits(model, batch_size, args, device):
+    """True if a training step of batch_size samples fits in cuda memory"""
+    try:
+        training_step(model, batch_size, args, device)
+        return True
+    except RuntimeError as error:
+        if 'out of memory' not in str(error):
+            raise
+        return False
+    finally:
+        torch.cuda.empty_cache()
+
+
+def max_batch_size_cuda(model, args, device):
+    """Largest batch size fitting in cuda memory, by doubling then bisection"""
+    low, high = 0, 1
+    while high <= args.max_batch_size and fits(model, high, args, device):
+        low, high = high, high * 2
+    high = min(high, args.max_batch_size + 1)
+    while high - low > 1:
+        middle = (low + high) // 2
+        low, high = (middle, high) if fits(model, middle, args, device) else (low, middle)
+    return low
+
+
+def cpu_peak_memory(case):
+    """Peak memory (MB) of a training step on cpu. Runs in its own process, so that the peak is the one of this step."""
+    model_name, checkpoint_stages, batch_size, args = case
+    model = MODELS[model_name](args.num_classes, args.bands, checkpoint_stages=checkpoint_stages).train()
+    baseline_mb = peak_rss_mb()
+    training_step(model, batch_size, args, torch.device('cpu'))
+    return peak_rss_mb() - baseline_mb
+
+
+def max_batch_size_cpu(model_name, checkpoint_stages, args):
+    """Largest batch size whose training step fits in args.memory_limit GB, extrapolated from the peak memory of two
+    small batches (activation memory grows linearly with the batch size)"""
+    small, large = args.cpu_batch_sizes
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        peaks = pool.map(cpu_peak_memory, [(model_name, checkpoint_stages, batch_size, args)
+                                           for batch_size in (small, large)])
+    per_sample_mb = max((peaks[1] - peaks[0]) / (large - small), 1e-6)
+    fixed_mb = peaks[0] - small * per_sample_mb
+    return int((args.memory_limit * 1024 - fixed_mb) // per_sample_mb), per_sample_mb
+
+
+def main(args):
+    """
+    Checks that checkpointing does not update the batch norm statistics twice, then finds the largest training batch
+    size of the UNet models, without and with activation checkpointing. On cuda, the batch size is searched until out
+    of memory. On cpu, it is extrapolated from the peak memory of small batches.
+    """
+    device = torch.device(args.device if args.device else 'cuda' if torch.cuda.is_available() else 'cpu')
+    check_batch_norm_stats(args, device)
+    for model_name in args.models:
+        for checkpoint_stages in [None] + args.checkpoint_stages:
+            description = f"{model_name}, checkpoint_stages={checkpoint_stages}, samples_size {args.samples_size}"
+            if device.type == 'cuda':
+                model = MODELS[model_name](args.num_classes, args.bands, checkpoint_stages=checkpoint_stages)
+                max_batch_size = max_batch_size_cuda(model.to(device).train(), args, device)
+                print(f"{description}: max batch size {max_batch_size} on {torch.cuda.get_device_name(device)}")
+                del model
+            else:
+                max_batch_size, per_sample_mb = max_batch_size_cpu(model_name, checkpoint_stages, args)
+                print(f"{description}: {per_sample_mb:.0f} MB per sample, max batch size {max_batch_size} in "
+                      f"{args.memory_limit} GB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory benchmark of activation checkpointing in the UNet models')
+    parser.add_argument('--models', nargs='+', default=list(MODELS), choices=list(MODELS))
+    parser.add_argument('--checkpoint_stages', nargs='+', default=['encoder', 'all'],
+                        help='checkpoint_stages values compared to no checkpointing')
+    parser.add_argument('--samples_size', type=int, default=512)
+    parser.add_argument('--bands', type=int, default=3)
+    parser.add_argument('--num_classes', type=int, default=5)
+    parser.add_argument('--max_batch_size', type=int, default=1024, help='cuda search limit')
+    parser.add_argument('--memory_limit', type=float, default=16, help='memory (GB) available for training, on cpu')
+    parser.add_argument('--cpu_batch_sizes', type=int, nargs=2, default=[1, 2],
+                        help='batch sizes measured on cpu to extrapolate the max batch size')
+    parser.add_argument('--device', default=None, help='defaults to cuda if available, else cpu')
+    main(parser.parse_args())
@@ -0,0 +1,79 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from utils.metrics import ConfusionMatrix
+
+
+def brute_force_matrix(preds, labels, num_classes, ignore_index):
+    """Confusion matrix counted pixel by pixel"""
+    matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+    for pred, label in zip(preds.reshape(-1).tolist(), labels.reshape(-1).tolist()):
+        if 0 <= label < num_classes and label != ignore_index:
+            matrix[label, pred] += 1
+    return matrix
+
+
+def make_batches(num_batches, batch_size, num_classes, samples_size, ignore_index, device):
+    """Random predictions and labels, with ignored pixels and labels outside of the classes"""
+    gen = torch.Generator().manual_seed(0)
+    batches = []
+    for _ in range(num_batches):
+        preds = torch.randint(0, num_classes, (batch_size, samples_size, samples_size), generator=gen)
+        labels = torch.randint(0, num_classes + 1, (batch_size, samples_size, samples_size), generator=gen)
+        labels[torch.rand(labels.shape, generator=gen) < 0.05] = ignore_index
+        batches.append((preds.to(device), labels.to(device)))
+    return batches
+
+
+def check_counts(args, device):
+    """update() and merge() of partial matrices must give the brute force count of all the batches"""
+    for ignore_index in [-1, 0, None]:
+        batches = make_batches(6, 2, args.num_classes, 16, -1 if ignore_index is None else ignore_index, device)
+        expected = sum(brute_force_matrix(preds.cpu(), labels.cpu(), args.num_classes, ignore_index)
+                       for preds, labels in batches)
+
+        single = ConfusionMatrix(args.num_classes, ignore_index=ignore_index, device=device)
+        for preds, labels in batches:
+            single.update(preds, labels)
+        assert np.array_equal(single.matrix.cpu().numpy(), expected), f'update differs (ignore_index={ignore_index})'
+
+        # shards of the batches, as seen by different processes, merged afterwards
+        shards = [ConfusionMatrix(args.num_classes, ignore_index=ignore_index, device=device) for _ in range(3)]
+        for i, (preds, labels) in enumerate(batches):
+            shards[i % len(shards)].update(preds, labels)
+        merged = shards[0].merge(shards[1]).merge(shards[2])
+        assert np.array_equal(merged.matrix.cpu().numpy(), expected), f'merge differs (ignore_index={ignore_index})'
+    print('update and merge give the brute force confusion matrix')
+
+
+def main(args):
+    """
+    Checks ConfusionMatrix.update and merge against a brute force count, then times update on random batches.
+    """
+    device = torch.device(args.device if args.device else 'cuda' if torch.cuda.is_available() else 'cpu')
+    check_counts(args, device)
+
+    batches = make_batches(args.repeat, args.batch_size, args.num_classes, args.samples_size, -1, device)
+    confusion_matrix = ConfusionMatrix(args.num_classes, ignore_index=-1, device=device)
+    times = []
+    for preds, labels in batches:
+        start = time.perf_counter()
+        confusion_matrix.update(preds, labels)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+    print(f"ConfusionMatrix.update: {np.median(times) * 1000:.2f} ms per batch of "
+          f"{args.batch_size}x{args.samples_size}x{args.samples_size} on {device} (median of {args.repeat})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check and benchmark of ConfusionMatrix')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_classes', type=int, default=5)
+    parser.add_argument('--samples_size', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--device', default=None, help='defaults to cuda if available, else cpu')
+    main(parser.parse_args())
@@ -0,0 +1,92 @@
+import argparse
+import time
+import types
+
+import numpy as np
+import torch
+
+from models import coordconv, unet
+
+
+def uncached_forward(self, in_tensor):
+    """Previous AddCoords.forward, building the coordinates map on the cpu at every call"""
+    batch_size, channels, height, width = in_tensor.shape
+    coords_map = coordconv.get_coords_map(height, width, self.centered, self.normalized, self.noise)
+    if self.scale is not None:
+        coords_map *= self.scale
+    if self.radius_channel:
+        middle_slice = coords_map[:, (height - 1) // 2, (width - 1) // 2]
+        radius = torch.sqrt(torch.pow(coords_map[0, :, :] - middle_slice[0], 2) +
+                            torch.pow(coords_map[1, :, :] - middle_slice[1], 2))
+        coords_map = torch.cat([coords_map, radius.unsqueeze(0)], dim=0)
+    coords_map = coords_map.repeat(batch_size, 1, 1, 1)
+    dev = in_tensor.device
+    out = torch.cat([in_tensor, coords_map.to(dev)], dim=1)
+    return out
+
+
+def make_model(args, cached, device):
+    torch.manual_seed(0)
+    model = unet.UNetSmall(args.num_classes, args.bands)
+    model = coordconv.swap_coordconv_layers(model, noise=args.noise, radius_channel=args.radius_channel)
+    if not cached:
+        for module in model.modules():
+            if isinstance(module, coordconv.AddCoords):
+                module.forward = types.MethodType(uncached_forward, module)
+    return model.to(device).train()
+
+
+def step_time(model, args, device):
+    """Median time of a training step (forward, backward and optimizer step)"""
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    inputs = torch.randn(args.batch_size, args.bands, args.samples_size, args.samples_size, device=device)
+    labels = torch.randint(0, args.num_classes, (args.batch_size, args.samples_size, args.samples_size),
+                           device=device)
+    times = []
+    for i in range(args.warmup + args.repeat):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        optimizer.zero_grad()
+        torch.nn.functional.cross_entropy(model(inputs), labels).backward()
+        optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        if i >= args.warmup:
+            times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+def main(args):
+    """
+    Training step time of a CoordConv UNet (unetsmall with coordconv_convert), with the previous AddCoords building the
+    coordinates maps at every forward pass and with the cached coordinates maps. Without noise, both must give the
+    same outputs.
+    """
+    device = torch.device(args.device if args.device else 'cuda' if torch.cuda.is_available() else 'cpu')
+    if args.noise is None:
+        inputs = torch.randn(2, args.bands, 64, 64, device=device)
+        with torch.no_grad():
+            outputs = [make_model(args, cached, device).eval()(inputs) for cached in [False, True]]
+        assert torch.allclose(*outputs, rtol=1e-4, atol=1e-5), 'cached and uncached coordinates maps differ'
+        print('cached and uncached coordinates maps give the same outputs')
+
+    for cached in [False, True]:
+        duration = step_time(make_model(args, cached, device), args, device)
+        print(f"{'cached' if cached else 'uncached'} coordinates maps: {duration * 1000:.1f} ms per training step on "
+              f"{device} (median of {args.repeat}, batch of {args.batch_size}x{args.bands}x{args.samples_size}x"
+              f"{args.samples_size})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the coordinates maps cache of CoordConv layers')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--bands', type=int, default=3)
+    parser.add_argument('--num_classes', type=int, default=5)
+    parser.add_argument('--samples_size', type=int, default=256)
+    parser.add_argument('--noise', type=float, default=None, help='coordconv_noise')
+    parser.add_argument('--radius_channel', action='store_true', help='coordconv_radius_channel')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--device', default=None, help='defaults to cuda if available, else cpu')
+    main(parser.parse_args())
@@ -0,0 +1,65 @@
+import argparse
+import json
+import subprocess
+import sys
+
+ENTRY_POINTS = ['train_segmentation', 'train_classification', 'inference', 'images_to_samples', 'utils.utils']
+
+
+def import_times(module):
+    """
+    Imports a module in a new interpreter with python -X importtime.
+    :return: (dict) cumulative import time in microseconds of the module, under its own name, and of each module it
+             imports directly
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                             stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError(f'import {module} failed: {process.stderr.splitlines()[-1]}')
+    children = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # modules are listed after the modules they import, indented by 2 spaces per nesting level
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        if level == 0:
+            if name.strip() == module:
+                return {module: int(cumulative), **children}
+            children = {}
+        elif level == 1:
+            children[name.strip()] = int(cumulative)
+    raise RuntimeError(f'{module} was not imported')
+
+
+def main(args):
+    """
+    Import time of the entry points, with the slowest packages they import. Each import runs in a new interpreter; the
+    minimum over args.repeat runs is kept.
+    """
+    report = {}
+    for module in args.modules:
+        try:
+            runs = [import_times(module) for _ in range(args.repeat)]
+        except RuntimeError as error:
+            print(f'{module}: skipped ({error})')
+            continue
+        times = {name: min(run.get(name, run[module]) for run in runs) for name in runs[0]}  # min over runs
+        total = times.pop(module)
+        slowest = sorted(times.items(), key=lambda item: item[1], reverse=True)[:args.top]
+        report[module] = {'total_ms': total / 1000, 'slowest_imports_ms': {name: t / 1000 for name, t in slowest}}
+        print(f'{module}: {total / 1000:.0f} ms ({", ".join(f"{name} {t / 1000:.0f} ms" for name, t in slowest)})')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Report written to {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import time of the entry points (python -X importtime)')
+    parser.add_argument('--modules', nargs='+', default=ENTRY_POINTS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=5, help='number of slowest imports listed per entry point')
+    parser.add_argument('--output', default=None, help='path of an optional JSON report')
+    main(parser.parse_args())
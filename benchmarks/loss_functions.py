@@ -0,0 +1,126 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+from losses import MultiClassCriterion
+
+LOSS_TYPES = ['CrossEntropy', 'Lovasz', 'OhemCrossEntropy', 'Focal', 'PixelFocal']
+
+
+def peak_rss_mb():
+    """Peak resident set size of the current process, in MB (ru_maxrss is in KB on Linux, in bytes on macOS)"""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2 ** 20 if sys.platform == 'darwin' else maxrss / 2 ** 10
+
+
+def run_case(case):
+    """
+    Times the forward and backward passes of one loss function on a random batch. Runs in its own process, so that the
+    peak memory measured is the one of this case only.
+    :param case: (dict) loss_fn, batch_size, num_classes, samples_size, ignore_index, repeat, warmup, device
+    :return: (dict) the case, with the median time in ms and the peak memory used by the loss in MB
+    """
+    device = torch.device(case['device'])
+    gen = torch.Generator().manual_seed(0)
+    shape = (case['batch_size'], case['num_classes'], case['samples_size'], case['samples_size'])
+    logits = torch.randn(*shape, generator=gen).to(device)
+    labels = torch.randint(0, case['num_classes'], (shape[0], *shape[2:]), generator=gen)
+    labels[torch.rand(labels.shape, generator=gen) < 0.05] = case['ignore_index']
+    labels = labels.to(device)
+    criterion = MultiClassCriterion(loss_type=case['loss_fn'], ignore_index=case['ignore_index']).to(device)
+
+    baseline_mb = peak_rss_mb()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline_mb = torch.cuda.memory_allocated(device) / 2 ** 20
+    times = []
+    for i in range(case['warmup'] + case['repeat']):
+        inputs = logits.detach().requires_grad_()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        criterion(inputs, labels).backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        if i >= case['warmup']:
+            times.append(time.perf_counter() - start)
+    peak_mb = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else peak_rss_mb()
+
+    return {**case, 'median_ms': float(np.median(times)) * 1000, 'peak_memory_mb': peak_mb - baseline_mb}
+
+
+def case_key(result):
+    return tuple(result[k] for k in ['loss_fn', 'batch_size', 'num_classes', 'samples_size', 'device'])
+
+
+def compare(results, baseline_path, tolerance):
+    """
+    Prints the cases slower or using more memory than in a previous report, by more than tolerance.
+    :return: (int) number of regressions
+    """
+    with open(baseline_path) as f:
+        baseline = {case_key(result): result for result in json.load(f)['results']}
+    regressions = 0
+    for result in results:
+        previous = baseline.get(case_key(result))
+        if previous is None:
+            continue
+        for metric in ['median_ms', 'peak_memory_mb']:
+            if result[metric] > previous[metric] * (1 + tolerance) and result[metric] - previous[metric] > 1:
+                print(f"REGRESSION {case_key(result)} {metric}: {previous[metric]:.1f} -> {result[metric]:.1f}")
+                regressions += 1
+    return regressions
+
+
+def main(args):
+    """
+    Times the forward and backward passes and measures the peak memory of every MultiClassCriterion loss function,
+    for each combination of batch size, number of classes and tile size. Each case runs in a new process. Results are
+    written to a JSON report, which can be compared to a previous one with --baseline.
+    """
+    cases = [dict(loss_fn=loss_fn, batch_size=batch_size, num_classes=num_classes, samples_size=samples_size,
+                  ignore_index=args.ignore_index, repeat=args.repeat, warmup=args.warmup, device=args.device)
+             for loss_fn, batch_size, num_classes, samples_size
+             in itertools.product(args.loss_fn, args.batch_size, args.num_classes, args.samples_size)]
+
+    results = []
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        for result in pool.imap(run_case, cases):
+            print(f"{result['loss_fn']:>16} batch {result['batch_size']:>3}, {result['num_classes']:>2} classes, "
+                  f"{result['samples_size']:>4} px: {result['median_ms']:9.1f} ms, "
+                  f"{result['peak_memory_mb']:8.1f} MB")
+            results.append(result)
+
+    report = {'torch': torch.__version__, 'python': platform.python_version(), 'platform': platform.platform(),
+              'num_threads': torch.get_num_threads(), 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Report written to {args.output}')
+
+    if args.baseline and compare(results, args.baseline, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the loss functions of MultiClassCriterion')
+    parser.add_argument('--loss_fn', nargs='+', default=LOSS_TYPES, choices=LOSS_TYPES)
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[4, 16])
+    parser.add_argument('--num_classes', type=int, nargs='+', default=[2, 5])
+    parser.add_argument('--samples_size', type=int, nargs='+', default=[256, 512])
+    parser.add_argument('--ignore_index', type=int, default=-1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--output', default='loss_benchmark.json', help='path of the JSON report')
+    parser.add_argument('--baseline', default=None, help='previous JSON report to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative increase of time or memory reported as a regression')
+    main(parser.parse_args())
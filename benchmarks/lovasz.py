@@ -0,0 +1,137 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from losses.lovasz_loss import lovasz_softmax_batched
+
+
+def lovasz_grad(gt_sorted):
+    p = len(gt_sorted)
+    gts = gt_sorted.sum()
+    intersection = gts - gt_sorted.float().cumsum(0)
+    union = gts + (1 - gt_sorted).float().cumsum(0)
+    jaccard = 1 - intersection / union
+    if p > 1:  # cover 1-pixel case
+        jaccard[1:p] = jaccard[1:p] - jaccard[0:-1]
+    return jaccard
+
+
+def lovasz_softmax_flat(prb, lbl, ignore_index, only_present):
+    """
+    Multi-class Lovasz-Softmax loss
+      probas: [P, C] Variable, class probabilities at each prediction (between 0 and 1)
+      labels: [P] Tensor, ground truth labels (between 0 and C - 1)
+      only_present: average only on classes present in ground truth
+    """
+    C = prb.shape[0]
+    prb = prb.permute(1, 2, 0).contiguous().view(-1, C)  # H * W, C
+    lbl = lbl.view(-1)  # H * W
+    if ignore_index is not None:
+        valid_index = lbl != ignore_index
+        if valid_index.sum() == 0:
+            return torch.mean(prb * 0)
+        prb = prb[valid_index]
+        lbl = lbl[valid_index]
+
+    total_loss = 0
+    cnt = 0
+    for c in range(C):
+        fg = (lbl == c).float()  # foreground for class c
+        if only_present and fg.sum() == 0:
+            continue
+        errors = (fg - prb[:, c]).abs()
+        errors_sorted, perm = torch.sort(errors, dim=0, descending=True)
+        perm = perm.data
+        fg_sorted = fg[perm]
+        total_loss += torch.dot(errors_sorted, lovasz_grad(fg_sorted))
+        cnt += 1
+    try:
+        return total_loss / cnt
+    except:
+        pass
+
+
+def lovasz_softmax_loop(probas, labels, ignore_index, only_present):
+    """Previous implementation of LovaszSoftmax.forward, one sort per sample and per class"""
+    total_loss = 0
+    for prb, lbl in zip(probas, labels):
+        total_loss += lovasz_softmax_flat(prb, lbl, ignore_index, only_present)
+    return total_loss / probas.shape[0]
+
+
+def make_batch(batch_size, num_classes, samples_size, ignore_index, device):
+    """Random logits and labels, with a few ignored pixels and, if possible, a sample without one of the classes"""
+    gen = torch.Generator().manual_seed(0)
+    logits = torch.randn(batch_size, num_classes, samples_size, samples_size, generator=gen)
+    labels = torch.randint(0, num_classes, (batch_size, samples_size, samples_size), generator=gen)
+    if num_classes > 1:
+        labels[0][labels[0] == num_classes - 1] = 0
+    if ignore_index is not None:
+        labels[torch.rand(labels.shape, generator=gen) < 0.05] = ignore_index
+    return logits.to(device), labels.to(device)
+
+
+def loss_and_grad(loss_fn, logits, labels, ignore_index, only_present):
+    logits = logits.detach().requires_grad_()
+    loss = loss_fn(F.softmax(logits, dim=1), labels, ignore_index, only_present)
+    loss.backward()
+    return loss.item(), logits.grad
+
+
+def check_equivalence(args, device):
+    """Batched and per-sample implementations must give the same loss and gradients"""
+    for only_present in [True, False]:
+        for ignore_index in [None, args.ignore_index]:
+            logits, labels = make_batch(4, args.num_classes, 32, ignore_index, device)
+            loop_loss, loop_grad = loss_and_grad(lovasz_softmax_loop, logits, labels, ignore_index, only_present)
+            batched_loss, batched_grad = loss_and_grad(lovasz_softmax_batched, logits, labels, ignore_index,
+                                                       only_present)
+            assert np.isclose(loop_loss, batched_loss, rtol=1e-4, atol=1e-6), \
+                f'losses differ (only_present={only_present}, ignore_index={ignore_index}): ' \
+                f'{loop_loss} != {batched_loss}'
+            assert torch.allclose(loop_grad, batched_grad, rtol=1e-4, atol=1e-6), \
+                f'gradients differ (only_present={only_present}, ignore_index={ignore_index})'
+    print('batched and per-sample implementations give the same losses and gradients')
+
+
+def time_forward_backward(loss_fn, logits, labels, ignore_index, repeat, device):
+    times = []
+    for _ in range(repeat):
+        logits = logits.detach().requires_grad_()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        loss_fn(F.softmax(logits, dim=1), labels, ignore_index, True).backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+def main(args):
+    """
+    Checks that the batched Lovasz-Softmax loss matches the per-sample implementation, then times the forward and
+    backward passes of both on a random batch.
+    """
+    device = torch.device(args.device if args.device else 'cuda' if torch.cuda.is_available() else 'cpu')
+    check_equivalence(args, device)
+
+    logits, labels = make_batch(args.batch_size, args.num_classes, args.samples_size, args.ignore_index, device)
+    for name, loss_fn in [('per-sample', lovasz_softmax_loop), ('batched', lovasz_softmax_batched)]:
+        duration = time_forward_backward(loss_fn, logits, labels, args.ignore_index, args.repeat, device)
+        print(f"{name} Lovasz-Softmax: {duration * 1000:.1f} ms forward and backward on {device} "
+              f"(median of {args.repeat} runs, batch of {tuple(logits.shape)})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the Lovasz-Softmax loss')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_classes', type=int, default=5)
+    parser.add_argument('--samples_size', type=int, default=256)
+    parser.add_argument('--ignore_index', type=int, default=255)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--device', default=None, help='defaults to cuda if available, else cpu')
+    main(parser.parse_args())
@@ -0,0 +1,164 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import platform
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from torch import nn
+
+from benchmarks.loss_functions import peak_rss_mb
+from models.model_choice import net
+
+MODEL_NAMES = ['unet', 'unetsmall', 'checkpointed_unet', 'ternausnet', 'inception', 'fcn_resnet101',
+               'deeplabv3_resnet101']
+
+
+def make_params(model_name, num_bands):
+    """Minimal parameters used by model_choice.net. Pretrained weights are never downloaded."""
+    return {'global': {'model_name': model_name, 'number_of_bands': num_bands},
+            'training': {'pretrained': False}}
+
+
+def forward(model, inputs):
+    outputs = model(inputs)
+    return outputs['out'] if isinstance(outputs, OrderedDict) else outputs
+
+
+def count_flops(model, inputs):
+    """
+    Floating point operations of a forward pass, counted on the convolution and linear layers (2 per multiply-add),
+    which make most of the compute of these models.
+    """
+    flops = []
+
+    def conv_hook(module, hook_inputs, output):
+        kernel_ops = (module.in_channels // module.groups) * int(np.prod(module.kernel_size))
+        flops.append(2 * output.numel() * kernel_ops)
+
+    def conv_transpose_hook(module, hook_inputs, output):
+        kernel_ops = (module.out_channels // module.groups) * int(np.prod(module.kernel_size))
+        flops.append(2 * hook_inputs[0].numel() * kernel_ops)
+
+    def linear_hook(module, hook_inputs, output):
+        flops.append(2 * output.numel() * module.in_features)
+
+    hooks = {nn.Conv2d: conv_hook, nn.ConvTranspose2d: conv_transpose_hook, nn.Linear: linear_hook}
+    handles = [module.register_forward_hook(hooks[type(module)]) for module in model.modules()
+               if type(module) in hooks]
+    with torch.no_grad():
+        forward(model, inputs)
+    for handle in handles:
+        handle.remove()
+    return sum(flops)
+
+
+def profile_case(case):
+    """
+    Profiles one model at one batch size. Runs in its own process, so that the peak memory measured is the one of this
+    case only.
+    :param case: (dict) model_name, batch_size, num_bands, num_classes, samples_size, repeat, warmup, device
+    :return: (dict) the case with params, gflops, median forward and backward times (ms) and peak memory (MB), or
+             with the error raised by the model
+    """
+    device = torch.device(case['device'])
+    try:
+        model, _, _ = net(make_params(case['model_name'], case['num_bands']), case['num_classes'])
+        model = model.to(device).train()
+        shape = (case['batch_size'], case['num_bands'], case['samples_size'], case['samples_size'])
+        inputs = torch.randn(*shape, device=device)
+        labels = torch.randint(0, case['num_classes'], (shape[0], *shape[2:]), device=device)
+
+        baseline_mb = peak_rss_mb()
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+            baseline_mb = torch.cuda.memory_allocated(device) / 2 ** 20
+
+        def synchronize():
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+
+        forward_times, backward_times = [], []
+        for i in range(case['warmup'] + case['repeat']):
+            synchronize()
+            start = time.perf_counter()
+            outputs = forward(model, inputs)
+            loss = nn.functional.cross_entropy(outputs, labels) if outputs.dim() == 4 else outputs.mean()
+            synchronize()
+            middle = time.perf_counter()
+            loss.backward()
+            synchronize()
+            if i >= case['warmup']:
+                forward_times.append(middle - start)
+                backward_times.append(time.perf_counter() - middle)
+            model.zero_grad(set_to_none=True)
+            outputs = loss = None
+        peak_mb = torch.cuda.max_memory_allocated(device) / 2 ** 20 if device.type == 'cuda' else peak_rss_mb()
+
+        return {**case,
+                'params': sum(p.numel() for p in model.parameters()),
+                'gflops': count_flops(model.eval(), inputs) / 1e9,
+                'forward_ms': float(np.median(forward_times)) * 1000,
+                'backward_ms': float(np.median(backward_times)) * 1000,
+                'peak_memory_mb': peak_mb - baseline_mb,
+                'error': None}
+    except (AssertionError, RuntimeError, ValueError) as error:
+        return {**case, 'error': f'{type(error).__name__}: {error}'}
+
+
+def write_report(results, output):
+    """Writes the results to a csv file if output ends with .csv, to a json file otherwise"""
+    if output.endswith('.csv'):
+        fields = list(OrderedDict.fromkeys(key for result in results for key in result))
+        with open(output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        report = {'torch': torch.__version__, 'python': platform.python_version(), 'platform': platform.platform(),
+                  'num_threads': torch.get_num_threads(), 'results': results}
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def main(args):
+    """
+    Profiles the models of model_choice.net for a number of bands, classes and tile size, across batch sizes: number
+    of parameters, forward FLOPs, forward and backward latency, and peak memory (resident set size on cpu, allocator
+    on cuda). Each case runs in a new process. Results are written to a JSON or CSV report.
+    """
+    cases = [dict(model_name=model_name, batch_size=batch_size, num_bands=args.bands, num_classes=args.num_classes,
+                  samples_size=args.samples_size, repeat=args.repeat, warmup=args.warmup, device=args.device)
+             for model_name in args.models for batch_size in args.batch_size]
+
+    results = []
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        for result in pool.imap(profile_case, cases):
+            description = f"{result['model_name']:>20} batch {result['batch_size']:>3}"
+            if result['error']:
+                print(f"{description}: skipped ({result['error']})")
+            else:
+                print(f"{description}: {result['params'] / 1e6:7.1f} M params, {result['gflops']:8.1f} GFLOPs, "
+                      f"forward {result['forward_ms']:8.1f} ms, backward {result['backward_ms']:8.1f} ms, "
+                      f"{result['peak_memory_mb']:8.1f} MB")
+            results.append(result)
+
+    write_report(results, args.output)
+    print(f'Report written to {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Profile of the models available in model_choice.net')
+    parser.add_argument('--models', nargs='+', default=MODEL_NAMES, choices=MODEL_NAMES)
+    parser.add_argument('--bands', type=int, default=3)
+    parser.add_argument('--num_classes', type=int, default=5, help='number of output channels')
+    parser.add_argument('--samples_size', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--output', default='model_profile.json', help='path of the report, .json or .csv')
+    main(parser.parse_args())
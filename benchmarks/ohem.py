@@ -0,0 +1,124 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from losses.ohem_loss import OhemCrossEntropy2d
+
+
+class NumpyOhemCrossEntropy2d(OhemCrossEntropy2d):
+    """Previous implementation of OhemCrossEntropy2d, computing the kept pixels with NumPy on the CPU. The mask is sent
+    back to the device of the predictions, instead of always to cuda."""
+    def __init__(self, thresh=0.6, min_kept=0, weight=None, ignore_index=255):
+        super().__init__(thresh, min_kept, weight, ignore_index)
+        self.criterion = nn.CrossEntropyLoss(weight=weight, ignore_index=ignore_index)
+
+    def forward(self, predict, target):
+        n, c, h, w = predict.size()
+        input_label = target.data.cpu().numpy().ravel().astype(np.int32)
+        x = np.rollaxis(predict.data.cpu().numpy(), 1).reshape((c, -1))
+        input_prob = np.exp(x - x.max(axis=0).reshape((1, -1)))
+        input_prob /= input_prob.sum(axis=0).reshape((1, -1))
+
+        valid_flag = input_label != self.ignore_label
+        valid_inds = np.where(valid_flag)[0]
+        label = input_label[valid_flag]
+        num_valid = valid_flag.sum()
+        if self.min_kept >= num_valid:
+            pass
+        elif num_valid > 0:
+            prob = input_prob[:, valid_flag]
+            pred = prob[label, np.arange(len(label), dtype=np.int32)]
+            threshold = self.thresh
+            if self.min_kept > 0:
+                index = pred.argsort()
+                threshold_index = index[min(len(index), self.min_kept) - 1]
+                if pred[threshold_index] > self.thresh:
+                    threshold = pred[threshold_index]
+            kept_flag = pred <= threshold
+            valid_inds = valid_inds[kept_flag]
+
+        label = input_label[valid_inds].copy()
+        input_label.fill(self.ignore_label)
+        input_label[valid_inds] = label
+        target = torch.from_numpy(input_label.reshape(target.size())).long().to(predict.device)
+
+        return self.criterion(predict, target)
+
+
+def make_batch(batch_size, num_classes, samples_size, ignore_index, device):
+    """Random logits and labels, with a few ignored pixels"""
+    gen = torch.Generator().manual_seed(0)
+    logits = torch.randn(batch_size, num_classes, samples_size, samples_size, generator=gen)
+    labels = torch.randint(0, num_classes, (batch_size, samples_size, samples_size), generator=gen)
+    labels[torch.rand(labels.shape, generator=gen) < 0.05] = ignore_index
+    return logits.to(device), labels.to(device)
+
+
+def loss_and_grad(criterion, logits, labels):
+    logits = logits.detach().requires_grad_()
+    loss = criterion(logits, labels)
+    loss.backward()
+    return loss.item(), logits.grad
+
+
+def check_equivalence(args, device):
+    """Torch and NumPy implementations must give the same loss and gradients"""
+    weight = torch.rand(args.num_classes, generator=torch.Generator().manual_seed(1)).to(device)
+    logits, labels = make_batch(4, args.num_classes, 32, args.ignore_index, device)
+    num_pixels = labels.numel()
+    for min_kept in [0, 100, num_pixels // 2, num_pixels]:
+        for class_weight in [None, weight]:
+            kwargs = dict(thresh=args.thresh, min_kept=min_kept, weight=class_weight, ignore_index=args.ignore_index)
+            numpy_loss, numpy_grad = loss_and_grad(NumpyOhemCrossEntropy2d(**kwargs).to(device), logits, labels)
+            torch_loss, torch_grad = loss_and_grad(OhemCrossEntropy2d(**kwargs).to(device), logits, labels)
+            assert np.isclose(numpy_loss, torch_loss, rtol=1e-4, atol=1e-6), \
+                f'losses differ (min_kept={min_kept}): {numpy_loss} != {torch_loss}'
+            assert torch.allclose(numpy_grad, torch_grad, rtol=1e-4, atol=1e-6), \
+                f'gradients differ (min_kept={min_kept})'
+    print('torch and NumPy implementations give the same losses and gradients')
+
+
+def time_forward_backward(criterion, logits, labels, repeat, device):
+    times = []
+    for _ in range(repeat):
+        logits = logits.detach().requires_grad_()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        criterion(logits, labels).backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+def main(args):
+    """
+    Checks that the torch OHEM cross entropy matches the previous NumPy implementation, then times the forward and
+    backward passes of both on a random batch.
+    """
+    device = torch.device(args.device if args.device else 'cuda' if torch.cuda.is_available() else 'cpu')
+    check_equivalence(args, device)
+
+    logits, labels = make_batch(args.batch_size, args.num_classes, args.samples_size, args.ignore_index, device)
+    kwargs = dict(thresh=args.thresh, min_kept=args.min_kept, ignore_index=args.ignore_index)
+    for name, criterion in [('NumPy', NumpyOhemCrossEntropy2d(**kwargs)), ('torch', OhemCrossEntropy2d(**kwargs))]:
+        duration = time_forward_backward(criterion.to(device), logits, labels, args.repeat, device)
+        print(f"{name} OHEM cross entropy: {duration * 1000:.1f} ms forward and backward on {device} "
+              f"(median of {args.repeat} runs, batch of {tuple(logits.shape)})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the OHEM cross entropy loss')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_classes', type=int, default=3)
+    parser.add_argument('--samples_size', type=int, default=256)
+    parser.add_argument('--ignore_index', type=int, default=-1)
+    parser.add_argument('--thresh', type=float, default=0.6)
+    parser.add_argument('--min_kept', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--device', default=None, help='defaults to cuda if available, else cpu')
+    main(parser.parse_args())
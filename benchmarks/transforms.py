@@ -0,0 +1,70 @@
+import argparse
+import time
+
+import numpy as np
+
+from utils import augmentation as aug
+
+
+def make_params(num_classes, num_bands, hflip_prob, fused, mean=None, std=None):
+    """Minimal parameters used by compose_transforms. mean and std default to one value per band."""
+    return {'global': {'num_classes': num_classes},
+            'training': {'augmentation': {'hflip_prob': hflip_prob, 'rotate_limit': None, 'rotate_prob': None,
+                                          'fused_transform': fused},
+                         'normalization': {'mean': [0.5] * num_bands if mean is None else mean,
+                                           'std': [0.25] * num_bands if std is None else std}}}
+
+
+def make_samples(num_samples, samples_size, num_bands, num_classes):
+    """Random samples as read from the hdf5 files by SegmentationDataset"""
+    rng = np.random.RandomState(0)
+    return [{'sat_img': rng.rand(samples_size, samples_size, num_bands).astype(np.float32),
+             'map_img': rng.randint(0, num_classes + 1, (samples_size, samples_size)).astype(np.int16),
+             'metadata': None}
+            for _ in range(num_samples)]
+
+
+def check_normalization(args):
+    """The fused and current transforms must give the same samples, for per band, single and scalar mean and std"""
+    sample = make_samples(1, 32, args.bands, args.num_classes)[0]
+    for mean, std in [(None, None), ([0.5], [0.25]), (0.5, 0.25)]:
+        outputs = [aug.compose_transforms(make_params(args.num_classes, args.bands, None, fused, mean, std), 'val')(
+            dict(sample)) for fused in [False, True]]
+        assert np.allclose(outputs[0]['sat_img'].numpy(), outputs[1]['sat_img'].numpy(), rtol=1e-5, atol=1e-6), \
+            f'fused normalization differs for mean {mean} and std {std}'
+        assert np.array_equal(outputs[0]['map_img'].numpy(), outputs[1]['map_img'].numpy())
+    print('fused and current transforms give the same samples')
+
+
+def samples_per_sec(transform, samples):
+    start = time.perf_counter()
+    for sample in samples:
+        transform(sample)
+    return len(samples) / (time.perf_counter() - start)
+
+
+def main(args):
+    """
+    Checks that the fused transform normalizes like the current transforms, then measures the samples per second of
+    compose_transforms for the training dataset, with the current transforms and the fused transform. Transforms run
+    in a single process, so this is the throughput of one dataloader worker.
+    """
+    check_normalization(args)
+    for fused in [False, True]:
+        transform = aug.compose_transforms(make_params(args.num_classes, args.bands, args.hflip_prob, fused), 'trn')
+        rates = [samples_per_sec(transform, make_samples(args.num_samples, args.samples_size, args.bands,
+                                                         args.num_classes))
+                 for _ in range(args.repeat)]
+        print(f"{'fused' if fused else 'current'} transforms: {np.median(rates):.1f} samples/sec per worker "
+              f"(median of {args.repeat} runs of {args.num_samples} samples)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the dataloader transforms')
+    parser.add_argument('--samples_size', type=int, default=256)
+    parser.add_argument('--bands', type=int, default=4)
+    parser.add_argument('--num_classes', type=int, default=4)
+    parser.add_argument('--hflip_prob', type=float, default=0.5)
+    parser.add_argument('--num_samples', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    main(parser.parse_args())
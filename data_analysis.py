@@ -1,124 +1,192 @@
 import argparse
+import multiprocessing
 import os
+from functools import partial
 from pathlib import Path
-from utils.utils import read_parameters, read_csv, validate_num_classes, vector_to_raster, image_reader_as_array, get_key_def
 import time
+import warnings
 import rasterio
-import csv
 import numpy as np
-from collections import OrderedDict
-from numpy import genfromtxt
 from tqdm import tqdm
 
 import images_to_samples
+from utils.utils import vector_to_raster, get_key_def
+from utils.readers import read_parameters, read_csv, image_reader_as_array
+from utils.verifications import validate_num_classes
+from utils.histogram import tile_class_counts
+from utils.tiling import tile_origins
 
 
-def create_csv():
+# largest number of threshold combinations evaluated at once. Each one holds a value per class and per dataset.
+MAX_GRID_CELLS = 2 ** 22
+
+
+def prop_data_dtype(num_classes):
+    """Structured dtype of the class proportion table: proportion (%) of each class and dataset of every sample"""
+    return np.dtype([('prop', np.float64, (num_classes,)), ('dataset', 'U3')])
+
+
+class SampleStatistics(object):
+    """
+    Class statistics of a set of samples: class proportion table, pixels of each class, number of samples of each
+    dataset and histogram of the class proportions of the samples (0.1 % bins). Statistics of different images are
+    computed separately and merged afterwards; merging is associative, so images can be processed in any grouping.
+    The proportion table, needed by the threshold searches, grows with the number of samples; the other statistics
+    have a fixed size and summarize any number of images.
     """
-    Creates samples from the input images for the pixel_inventory function
+    datasets = ['trn', 'val', 'tst']
+    num_bins = 1001
+
+    def __init__(self, prop_data, pixels, dataset_count, histogram):
+        self.prop_data = prop_data
+        self.pixels = pixels
+        self.dataset_count = dataset_count
+        self.histogram = histogram
+
+    @classmethod
+    def empty(cls, num_classes):
+        return cls(np.empty(0, dtype=prop_data_dtype(num_classes)), np.zeros(num_classes, dtype=np.int64),
+                   np.zeros(len(cls.datasets), dtype=np.int64), np.zeros((num_classes, cls.num_bins), dtype=np.int64))
+
+    @classmethod
+    def from_counts(cls, counts, sample_size, dataset):
+        """
+        :param counts: (numpy array) pixels of each class in each sample, of shape (number of samples, num_classes)
+        :param sample_size: (int) Size (in pixel) of the samples
+        :param dataset: (str) Type of dataset of the samples. Can be 'trn' or 'val' or 'tst'
+        """
+        num_samples, num_classes = counts.shape
+        prop_data = np.empty(num_samples, dtype=prop_data_dtype(num_classes))
+        prop_data['prop'] = np.round(counts / sample_size ** 2 * 100, 1)
+        prop_data['dataset'] = dataset
+
+        dataset_count = np.zeros(len(cls.datasets), dtype=np.int64)
+        dataset_count[cls.datasets.index(dataset)] = num_samples
+        bins = np.rint(prop_data['prop'] * 10).astype(np.int64) + np.arange(num_classes) * cls.num_bins
+        histogram = np.bincount(bins.ravel(), minlength=num_classes * cls.num_bins).reshape(num_classes, cls.num_bins)
+        return cls(prop_data, counts.sum(axis=0, dtype=np.int64), dataset_count, histogram)
+
+    def merge(self, *others):
+        """Returns the statistics of the samples of self followed by the samples of others"""
+        stats = (self,) + others
+        return SampleStatistics(np.concatenate([s.prop_data for s in stats]),
+                                sum(s.pixels for s in stats),
+                                sum(s.dataset_count for s in stats),
+                                sum(s.histogram for s in stats))
+
+    def save(self, path):
+        np.savez(path, prop_data=self.prop_data, pixels=self.pixels, dataset_count=self.dataset_count,
+                 histogram=self.histogram)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['prop_data'], data['pixels'], data['dataset_count'], data['histogram'])
+
+    def proportion_summary(self, step=10):
+        """
+        Number of samples of each class in every range of class proportion, from the histogram
+        :param step: (int) width (in %) of the ranges, a divisor of 100
+        :return: (dict) for each class, the number of samples in [0, step[, [step, 2 * step[, ... and [100 - step, 100]
+        """
+        # the last range runs to the end of the histogram, so it includes the samples at 100 %
+        ranges = np.add.reduceat(self.histogram, np.arange(0, self.num_bins - 1, step * 10), axis=1)
+        return {c: ranges[c].tolist() for c in range(len(ranges))}
+
 
+def create_csv():
+    """
+    Computes the class proportions of the samples of every input image with the pixel_inventory function, one image
+    per worker process, and merges the statistics of all images. They are saved to prop_data.npz in the data path.
+    :return: (SampleStatistics) merged statistics of all samples
     """
     prep_csv_path = params['sample']['prep_csv_file']
-    dist_samples = params['sample']['samples_dist']
-    sample_size = params['global']['samples_size']
     data_path = params['global']['data_path']
+    num_classes = params['global']['num_classes'] + 1
     Path.mkdir(Path(data_path), exist_ok=True)
     data_prep_csv = read_csv(prep_csv_path)
 
-    csv_prop_data = params['global']['data_path'] + '/prop_data.csv'
-    if os.path.isfile(csv_prop_data):
-        os.remove(csv_prop_data)
-
-    with tqdm(data_prep_csv) as _tqdm:
-        for info in _tqdm:
-
-            _tqdm.set_postfix(OrderedDict(file=f'{info["tif"]}', sample_size=params['global']['samples_size']))
-
-            # Validate the number of class in the vector file
-            validate_num_classes(info['gpkg'], params['global']['num_classes'], info['attribute_name'])
-
-            assert os.path.isfile(info['tif']), f"could not open raster file at {info['tif']}"
-            with rasterio.open(info['tif'], 'r') as raster:
-
-                # Burn vector file in a raster file
-                np_label_raster = vector_to_raster(vector_file=info['gpkg'],
-                                                   input_image=raster,
-                                                   attribute_name=info['attribute_name'],
-                                                   fill=get_key_def('ignore_idx', get_key_def('training', params, {}),
-                                                                    0))
-
-                # Read the input raster image
-                np_input_image = image_reader_as_array(input_image=raster,
-                                                       scale=get_key_def('scale_data', params['global'], None),
-                                                       aux_vector_file=get_key_def('aux_vector_file', params['global'],
-                                                                                   None),
-                                                       aux_vector_attrib=get_key_def('aux_vector_attrib',
-                                                                                     params['global'], None),
-                                                       aux_vector_ids=get_key_def('aux_vector_ids', params['global'],
-                                                                                  None),
-                                                       aux_vector_dist_maps=get_key_def('aux_vector_dist_maps',
-                                                                                        params['global'], True),
-                                                       aux_vector_dist_log=get_key_def('aux_vector_dist_log',
-                                                                                       params['global'], True),
-                                                       aux_vector_scale=get_key_def('aux_vector_scale',
-                                                                                    params['global'], None))
-                # Mask the zeros from input image into label raster.
-                if params['sample']['mask_reference']:
-                    np_label_raster = images_to_samples.mask_image(np_input_image, np_label_raster)
-
-                np_label_raster = np.reshape(np_label_raster, (np_label_raster.shape[0], np_label_raster.shape[1], 1))
-
-                h, w, num_bands = np_input_image.shape
-
-                # half tile padding
-                half_tile = int(sample_size / 2)
-                pad_label_array = np.pad(np_label_raster, ((half_tile, half_tile), (half_tile, half_tile), (0, 0)),
-                                         mode='constant')
-
-                for row in range(0, h, dist_samples):
-                    for column in range(0, w, dist_samples):
-                        target = np.squeeze(pad_label_array[row:row + sample_size, column:column + sample_size, :], axis=2)
-
-                        pixel_inventory(target, sample_size, params['global']['num_classes'] + 1,
-                                        params['global']['data_path'], info['dataset'])
-
-
-def pixel_inventory(sample, sample_size, num_classes, data_path, dataset):
+    num_workers = min(get_key_def('num_workers', params['data_analysis'], None) or os.cpu_count(),
+                      max(len(data_prep_csv), 1))
+    inventory = partial(image_statistics, params=params)
+    with multiprocessing.Pool(num_workers) as pool:
+        image_stats = list(tqdm(pool.imap(inventory, data_prep_csv), total=len(data_prep_csv)))
+
+    stats = SampleStatistics.empty(num_classes).merge(*image_stats)
+    stats.save(os.path.join(data_path, 'prop_data.npz'))
+    return stats
+
+
+def image_statistics(info, params):
+    """
+    Burns the reference vector file of an image and computes the class statistics of its samples
+    :param info: (dict) line of the prep_csv_file describing the image
+    :param params: (dict) parameters from the yaml file, passed explicitly to run in a worker process
+    :return: (SampleStatistics) statistics of the samples of the image
     """
-    Calculates the proportions of the classes contained in a sample
-    :param sample: numpy array of the sample
+    # Validate the number of class in the vector file
+    validate_num_classes(info['gpkg'], params['global']['num_classes'], info['attribute_name'],
+                         get_key_def('ignore_index', get_key_def('training', params, {}), -1))
+
+    assert os.path.isfile(info['tif']), f"could not open raster file at {info['tif']}"
+    with rasterio.open(info['tif'], 'r') as raster:
+
+        # Burn vector file in a raster file
+        np_label_raster = vector_to_raster(vector_file=info['gpkg'],
+                                           input_image=raster,
+                                           attribute_name=info['attribute_name'],
+                                           fill=get_key_def('ignore_idx', get_key_def('training', params, {}), 0))
+
+        # Mask the zeros from input image into label raster.
+        if params['sample']['mask_reference']:
+            # Read the input raster image
+            np_input_image = image_reader_as_array(input_image=raster,
+                                                   scale=get_key_def('scale_data', params['global'], None),
+                                                   aux_vector_file=get_key_def('aux_vector_file', params['global'],
+                                                                               None),
+                                                   aux_vector_attrib=get_key_def('aux_vector_attrib',
+                                                                                 params['global'], None),
+                                                   aux_vector_ids=get_key_def('aux_vector_ids', params['global'],
+                                                                              None),
+                                                   aux_vector_dist_maps=get_key_def('aux_vector_dist_maps',
+                                                                                    params['global'], True),
+                                                   aux_vector_dist_log=get_key_def('aux_vector_dist_log',
+                                                                                   params['global'], True),
+                                                   aux_vector_scale=get_key_def('aux_vector_scale',
+                                                                                params['global'], None))
+            np_label_raster = images_to_samples.mask_image(np_input_image, np_label_raster)
+
+    return pixel_inventory(np_label_raster, params['global']['samples_size'], params['sample']['samples_dist'],
+                           params['global']['num_classes'] + 1, info['dataset'])
+
+
+def pixel_inventory(label_raster, sample_size, dist_samples, num_classes, dataset):
+    """
+    Calculates the proportions of the classes contained in every sample of an image, at once
+    :param label_raster: numpy array of the burned reference image, of shape (h, w)
     :param sample_size: (int) Size (in pixel) of the samples
-    :param num_classes: (dict) Number of classes in reference data
-    :param data_path: (str) path to the samples folder
-    :param dataset: (str) Type of dataset of the sample. Can be 'trn' or 'val' or 'tst'
-
+    :param dist_samples: (int) Distance (in pixel) between two samples
+    :param num_classes: (int) Number of classes in reference data
+    :param dataset: (str) Type of dataset of the image. Can be 'trn' or 'val' or 'tst'
+    :return: (SampleStatistics) statistics of the samples of the image
     """
-    sample_total = sample_size ** 2
-    samples_prop = []
-    for i in range(0, num_classes):
-        samples_prop.append(0.0)
-        if i in np.unique(sample.flatten()):
-            samples_prop[i] += (round((np.bincount(sample.flatten())[i] / sample_total) * 100, 1))
-    samples_prop.append(dataset)
-
-    f = open(data_path + '/prop_data.csv', 'a')
+    h, w = label_raster.shape[:2]
 
-    with f:
-        writer = csv.writer(f)
-        writer.writerow(samples_prop)
+    # samples are centered on their origin (half tile padding)
+    half_tile = int(sample_size / 2)
+    rows, columns = tile_origins(h, w, dist_samples)
+    counts = tile_class_counts(label_raster, rows - half_tile, columns - half_tile, sample_size, range(num_classes))
+    return SampleStatistics.from_counts(counts, sample_size, dataset)
 
 
 def minimum_annotated_percent(target_background_percent, min_annotated_percent):
     """
-    :param target_background_percent: background pixels in sample
+    :param target_background_percent: (numpy array) background pixels (%) in each sample
     :param min_annotated_percent: (int) Minimum % of non background pixels in sample, in order to consider it part of
     the dataset
-    :return: (Bool)
+    :return: (numpy array of bool) True for the samples to keep
     """
-    if float(target_background_percent) <= 100 - min_annotated_percent:
-        return True
-
-    return False
+    return target_background_percent <= 100 - min_annotated_percent
 
 
 def minimum_annotated_percent_search(classes, annotated_p, sampling, sample_data):
@@ -127,20 +195,16 @@ def minimum_annotated_percent_search(classes, annotated_p, sampling, sample_data
         keys.append('prop' + str(i))
     stats_dict = {key: [] for key in keys}
 
-    for i in tqdm(annotated_p):
-        prop_classes = {}
-        for j, (key, value) in enumerate(sampling.items()):
-            if j >= 2:
-                prop_classes.update({key: 0})
-
-        numbers_sample = {'trn': 0, 'val': 0, 'tst': 0}
-
-        for row in sample_data:
-            if minimum_annotated_percent(row[0], i):
-                compute_classes(classes, prop_classes, row, numbers_sample)
-
-        if parameters_search_dict(stats_dict, prop_classes, numbers_sample, i) is False:
-            break
+    # all thresholds of annotated_p at once: a sample is kept for threshold t if its annotated % is >= t
+    annotated = 100 - sample_data['prop'][:, [0]]
+    pixels, numbers = threshold_statistics(sample_data, classes, annotated, step=1)
+    prop, std = class_distribution(pixels)
+    thresholds = np.asarray(annotated_p)
+    best = best_threshold(std[thresholds], 'minimum annotated percent')
+    if best is None:
+        return None
+    best = thresholds[best[0]]
+    parameters_search_dict(stats_dict, prop[best], std[best], numbers[best], int(best))
 
     if len(sampling['method']) == 1:
         results(classes, stats_dict)
@@ -148,25 +212,14 @@ def minimum_annotated_percent_search(classes, annotated_p, sampling, sample_data
         return stats_dict
 
 
-def class_proportion(row, classes, source):
-    condition = []
-    if params['data_analysis']['optimal_parameters_search']:
-        for i in classes:
-            if float(row[i]) >= source[i]:
-                condition.append(1)
-        if len(condition) == len(classes):
-            return True
-        else:
-            return False
-
-    else:
-        for i in classes:
-            if float(row[i]) >= source[str(i)]:
-                condition.append(1)
-        if len(condition) == len(classes):
-            return True
-        else:
-            return False
+def class_proportion(sample_data, classes, thresholds):
+    """
+    :param sample_data: (numpy structured array) class proportion table, see prop_data_dtype()
+    :param classes: (list) classes to test
+    :param thresholds: (list) minimum proportion (%) of each class of classes
+    :return: (numpy array of bool) True for the samples where every class reaches its threshold
+    """
+    return np.all(sample_data['prop'][:, classes] >= np.asarray(thresholds, dtype=np.float64), axis=1)
 
 
 def class_proportion_search(classes, sampling, sample_data):
@@ -175,28 +228,35 @@ def class_proportion_search(classes, sampling, sample_data):
         keys.append('prop' + str(i))
     stats_dict = {key: [] for key in keys}
 
-    prop_classes = {}
     threshold = [float(0.0) for i in classes]
-
-    for i in classes:
-        if i != 0:
-            while threshold[i] < 100.0:
-
-                for j, (key, value) in enumerate(sampling.items()):
-                    if j >= 2:
-                        prop_classes.update({key: 0})
-
-                numbers_sample = {'trn': 0, 'val': 0, 'tst': 0}
-
-                for row in tqdm(sample_data):
-                    if class_proportion(row, classes, threshold):
-                        compute_classes(classes, prop_classes, row, numbers_sample)
-
-                if parameters_search_dict(stats_dict, prop_classes, numbers_sample, threshold) is False:
-                    break
-                else:
-                    val = threshold[i]
-                    threshold[i] = round(val + 0.1, 1)
+    search_classes = [i for i in classes if i != 0]
+
+    if get_key_def('grid_search', params['data_analysis'], False):
+        # every combination of thresholds of all classes at once
+        step = get_key_def('grid_step', params['data_analysis'], 1.0)
+        pixels, numbers = threshold_statistics(sample_data, classes, sample_data['prop'][:, search_classes], step)
+        prop, std = class_distribution(pixels)
+        best = best_threshold(std, 'class proportion')
+        if best is None:
+            return None
+        for i, j in zip(search_classes, best):
+            threshold[classes.index(i)] = round(j * step, 1)
+    else:
+        # one class after the other, every threshold of the current class at once
+        step = 0.1
+        for i in search_classes:
+            selected = sample_data[class_proportion(sample_data, classes, threshold)]
+            pixels, numbers = threshold_statistics(selected, classes, selected['prop'][:, [i]], step)
+            prop, std = class_distribution(pixels)
+            best = best_threshold(std, f'class {i} proportion')
+            if best is None:
+                return None
+            threshold[classes.index(i)] = round(int(best[0]) * step, 1)
+
+    mask = class_proportion(sample_data, classes, threshold)
+    prop_classes, numbers_sample = compute_classes(classes, sample_data, mask)
+    prop, std = class_distribution(np.asarray(list(prop_classes.values())))
+    parameters_search_dict(stats_dict, prop, std, numbers_sample, threshold)
 
     if len(sampling['method']) == 1:
         results(classes, stats_dict)
@@ -204,50 +264,106 @@ def class_proportion_search(classes, sampling, sample_data):
         return stats_dict
 
 
-def compute_classes(classes, dict_classes, row, numbers_dict):
-    for i in classes:
-        dict_classes[str(i)] += int((float(row[i]) / 100) * params['global']['samples_size'] ** 2)
-    if row[-1] == 'trn':
-        numbers_dict['trn'] += 1
-    elif row[-1] == 'val':
-        numbers_dict['val'] += 1
-    elif row[-1] == 'tst':
-        numbers_dict['tst'] += 1
+def threshold_statistics(sample_data, classes, criteria, step):
+    """
+    Pixels of each class and number of samples of each dataset, for every combination of thresholds on the criteria
+    columns at once. A sample is kept for a combination if each of its criteria is >= the matching threshold. Samples
+    are binned on the threshold grid, then suffix sums along every axis of the histogram give all the combinations.
+    :param sample_data: (numpy structured array) class proportion table, see prop_data_dtype()
+    :param classes: (list) classes to sum the pixels of
+    :param criteria: (numpy array) values to threshold, of shape (number of samples, number of criteria), in [0, 100]
+    :param step: (float) step of the threshold grid, which goes from 0 to 100
+    :raises ValueError: if the grid has more than MAX_GRID_CELLS combinations of thresholds
+    :return: (numpy arrays) pixels of shape (grid size, ..., len(classes)) and numbers of samples in trn, val and tst
+             datasets of shape (grid size, ..., 3), one grid axis per criterion
+    """
+    grid_size = int(round(100 / step)) + 1
+    num_criteria = criteria.shape[1]
+    num_cells = grid_size ** num_criteria
+    if num_cells > MAX_GRID_CELLS:
+        raise ValueError(f'The threshold grid of {num_criteria} classes with a step of {step} % has {num_cells} '
+                         f'combinations, more than the {MAX_GRID_CELLS} evaluated at once. Increase grid_step or set '
+                         f'grid_search to False.')
+    datasets = np.stack([sample_data['dataset'] == dataset for dataset in ['trn', 'val', 'tst']], axis=1)
+    values = np.concatenate([(sample_data['prop'][:, classes] / 100 *
+                              params['global']['samples_size'] ** 2).astype(np.int64), datasets], axis=1)
+
+    # small epsilon so that proportions lying on the grid (e.g. 0.3 / 0.1) are not floored one bin too low
+    bins = np.clip(np.floor(criteria / step + 1e-6).astype(np.int64), 0, grid_size - 1)
+    cells = np.ravel_multi_index(tuple(bins.T), (grid_size,) * num_criteria)
+    hist = np.stack([np.bincount(cells, weights=values[:, j], minlength=num_cells)
+                     for j in range(values.shape[1])], axis=-1).reshape((grid_size,) * num_criteria + (-1,))
+    for axis in range(num_criteria):
+        hist = np.flip(np.cumsum(np.flip(hist, axis=axis), axis=axis), axis=axis)
+    hist = np.rint(hist).astype(np.int64)
+    return hist[..., :len(classes)], hist[..., len(classes):]
+
+
+def best_threshold(std, name):
+    """
+    Thresholds giving the smallest standard deviation of the class proportions
+    :param std: (numpy array) std of every combination of thresholds, inf where no pixels are selected
+    :param name: (str) name of the thresholds, for the warning
+    :return: (tuple) index of the best thresholds in std, or None if no thresholds select any pixel
+    """
+    if not np.isfinite(std).any():
+        warnings.warn(f'No {name} threshold selects any pixel: no threshold satisfies the constraint.')
+        return None
+    return np.unravel_index(np.argmin(std), std.shape)
 
-    return numbers_dict, dict_classes
 
+def class_distribution(pixels):
+    """
+    Proportion (%) of each class and standard deviation of these proportions, along the last axis of pixels
+    :param pixels: (numpy array) pixels of each class, on the last axis
+    :return: (numpy arrays) proportions, same shape as pixels, and std, inf where no pixels are selected
+    """
+    total = pixels.sum(axis=-1, keepdims=True)
+    prop = np.round(pixels / np.maximum(total, 1) * 100, 1)
+    std = np.round(np.std(prop, axis=-1), 3)
+    return prop, np.where(total[..., 0] > 0, std, np.inf)
 
-def parameters_search_dict(stats_dict, prop_classes, numbers_sample, source):
 
-    if all(value == 0 for value in prop_classes.values()):
-        return False
+def compute_classes(classes, sample_data, mask):
+    """
+    Sums the pixels of each class and counts the samples of each dataset, for the samples selected by mask
+    :param classes: (list) classes to sum the pixels of
+    :param sample_data: (numpy structured array) class proportion table, see prop_data_dtype()
+    :param mask: (numpy array of bool) selected samples
+    :return: (dict) pixels of each class, (dict) number of samples in each dataset
+    """
+    selected = sample_data[mask]
+    pixels = (selected['prop'][:, classes] / 100 * params['global']['samples_size'] ** 2).astype(np.int64).sum(axis=0)
+    dict_classes = {str(c): int(p) for c, p in zip(classes, pixels)}
+    numbers_dict = {dataset: int(np.count_nonzero(selected['dataset'] == dataset)) for dataset in ['trn', 'val', 'tst']}
 
-    total_pixel = sum(prop_classes.values())
-    prop = [round(i / total_pixel * 100, 1) for i in prop_classes.values()]
-    std = round(np.std(prop), 3)
+    return dict_classes, numbers_dict
 
-    if std <= stats_dict['std'] or stats_dict['std'] == []:
 
-        if params['data_analysis']['sampling']['method'][0] == 'min_annotated_percent':
-            # adds 'map' value to stats_dict
-            stats_dict.update(map=source)
+def parameters_search_dict(stats_dict, prop, std, numbers_sample, source):
 
-        elif params['data_analysis']['sampling']['method'][0] == 'class_proportion':
-            # adds 'combination' value to stats_dict
-            stats_dict.update(combination=source)
+    if not np.isfinite(std):
+        return False
 
-        # adds 'std' value to stats_dict
-        stats_dict.update(std=std)
+    if params['data_analysis']['sampling']['method'][0] == 'min_annotated_percent':
+        # adds 'map' value to stats_dict
+        stats_dict.update(map=source)
 
-        # adds 'prop_class' value to stats_dict
-        for i in prop_classes:
-            stats_dict.update({'prop' + str(i): prop[int(i)]})
+    elif params['data_analysis']['sampling']['method'][0] == 'class_proportion':
+        # adds 'combination' value to stats_dict
+        stats_dict.update(combination=source)
 
-        # appends 'trn', 'val', 'tst' values to stats_dict
-        stats_dict.update(trn_data=numbers_sample)
+    # adds 'std' value to stats_dict
+    stats_dict.update(std=float(std))
 
-    else:
-        return False
+    # adds 'prop_class' value to stats_dict
+    for i, value in enumerate(prop):
+        stats_dict.update({'prop' + str(i): float(value)})
+
+    # appends 'trn', 'val', 'tst' values to stats_dict
+    if not isinstance(numbers_sample, dict):
+        numbers_sample = {dataset: int(n) for dataset, n in zip(['trn', 'val', 'tst'], numbers_sample)}
+    stats_dict.update(trn_data=numbers_sample)
 
 
 def results(classes, stats_dict):
@@ -278,73 +394,57 @@ def parameters_search(sampling, sample_data, classes):
 
     if sampling['method'][0] == 'min_annotated_percent':
         stats = minimum_annotated_percent_search(classes, annotated_p, sampling, sample_data)
-        if len(sampling['method']) == 2:
-            sample = []
-            for row in sample_data:
-                if minimum_annotated_percent(row[0], stats['map']):
-                    sample.append(row)
+        if len(sampling['method']) == 2 and stats is not None:
+            sample = sample_data[minimum_annotated_percent(sample_data['prop'][:, 0], stats['map'])]
             res = class_proportion_search(classes, sampling, sample)
             print('optimal minimum annotated percent :', stats['map'])
-            results(classes, res)
+            if res is not None:
+                results(classes, res)
 
     elif sampling['method'][0] == 'class_proportion':
         stats = class_proportion_search(classes, sampling, sample_data)
-        if len(sampling['method']) == 2:
-            sample = []
-            for row in sample_data:
-                if class_proportion(row, classes, stats['combination']):
-                    sample.append(row)
+        if len(sampling['method']) == 2 and stats is not None:
+            sample = sample_data[class_proportion(sample_data, classes, stats['combination'])]
             res = minimum_annotated_percent_search(classes, annotated_p, sampling, sample)
 
             print('optimal class threshold combination :', stats['combination'])
-            results(classes, res)
+            if res is not None:
+                results(classes, res)
 
 
 def main(params):
-    number_samples = {'trn': 0, 'val': 0, 'tst': 0}
-    prop_csv = params['global']['data_path'] + '/prop_data.csv'
+    prop_data_file = os.path.join(params['global']['data_path'], 'prop_data.npz')
     sampling = params['data_analysis']['sampling']
 
     if params['data_analysis']['create_csv']:
-        create_csv()
+        stats = create_csv()
+    else:
+        assert os.path.isfile(prop_data_file), f'Could not locate {prop_data_file}. Set create_csv to True.'
+        stats = SampleStatistics.load(prop_data_file)
+    sample_data = stats.prop_data
 
-    sample_data = genfromtxt(prop_csv, delimiter=',', dtype='|U8')
+    if get_key_def('debug_mode', params['global'], False):
+        print('Pixels from each class in all samples :', dict(enumerate(stats.pixels.tolist())))
+        print('Samples in each dataset :', dict(zip(SampleStatistics.datasets, stats.dataset_count.tolist())))
+        print('Samples of each class per 10 % range of class proportion :', stats.proportion_summary())
 
-    pixel_classes = {}
     classes = []
     for i, (key, value) in enumerate(sampling.items()):
         if i >= 2:
             classes.append(int(key))
-            pixel_classes.update({key: 0})
 
     if params['data_analysis']['optimal_parameters_search']:
         parameters_search(sampling, sample_data, classes)
 
     else:
-        for row in sample_data:
-            if len(sampling['method']) == 1:
-                if sampling['method'][0] == 'min_annotated_percent':
-                    if minimum_annotated_percent(row[0], sampling['map']):
-                        # adds pixel count to pixel_classes dict for each class in the image
-                        compute_classes(classes, pixel_classes, row, number_samples)
-
-                elif sampling['method'][0] == 'class_proportion':
-                    if class_proportion(row, classes, sampling):
-                        # adds pixel count to pixel_classes dict for each class in the image
-                        compute_classes(classes, pixel_classes, row, number_samples)
-
-            elif len(sampling['method']) == 2:
-                if sampling['method'][0] == 'min_annotated_percent':
-                    if minimum_annotated_percent(row[0], sampling['map']):
-                        if sampling['method'][1] == 'class_proportion':
-                            if class_proportion(row, classes, sampling):
-                                compute_classes(classes, pixel_classes, row, number_samples)
-
-                elif sampling['method'][0] == 'class_proportion':
-                    if class_proportion(row, classes, sampling):
-                        if sampling['method'][1] == 'min_annotated_percent':
-                            if minimum_annotated_percent(row[0], sampling['map']):
-                                compute_classes(classes, pixel_classes, row, number_samples)
+        mask = np.ones(len(sample_data), dtype=bool)
+        for method in sampling['method']:
+            if method == 'min_annotated_percent':
+                mask &= minimum_annotated_percent(sample_data['prop'][:, 0], sampling['map'])
+            elif method == 'class_proportion':
+                mask &= class_proportion(sample_data, classes, [sampling[str(i)] for i in classes])
+        # adds pixel count to pixel_classes dict for each class in the samples
+        pixel_classes, number_samples = compute_classes(classes, sample_data, mask)
 
         total_pixel = 0
         for i in pixel_classes:
@@ -11,18 +11,15 @@ from pathlib import Path
 from tqdm import tqdm
 from collections import OrderedDict
 
-from utils.CreateDataset import create_files_and_datasets, MetaSegmentationDataset
+from utils.CreateDataset import create_files_and_datasets, MetaSegmentationDataset, encode_metadata
 from utils.utils import vector_to_raster, get_key_def, lst_ids
+from utils.tiling import tile_origins, tile_view, split_tiles, image_key
+from utils.histogram import class_histogram, class_percentages, min_annotated_percent_mask, class_proportion_mask
 from utils.readers import read_parameters, image_reader_as_array, read_csv
 from utils.verifications import is_valid_geom, validate_num_classes
 
 # from rasterio.features import is_valid_geom #FIXME: wait for https://github.com/mapbox/rasterio/issues/1815 to be solved
 
-try:
-    import boto3
-except ModuleNotFoundError:
-    warnings.warn("The boto3 library couldn't be imported. Ignore if not using AWS s3 buckets", ImportWarning)
-    pass
 
 
 def mask_image(arrayA, arrayB):
@@ -99,49 +96,42 @@ def check_sampling_dict():
                 pass
 
 
-def minimum_annotated_percent(target_background_percent, min_annotated_percent):
-    if float(target_background_percent) <= 100 - min_annotated_percent:
-        return True
+def minimum_annotated_percent(class_counts, labels, min_annotated_percent):
+    """Returns, for each tile of the batch, whether it has at least min_annotated_percent % of non background pixels"""
+    return min_annotated_percent_mask(class_counts, labels, min_annotated_percent)
 
-    return False
 
+def class_proportion(class_counts, labels):
+    """Returns, for each tile of the batch, whether every class reaches the proportion requested in the sampling dict"""
+    thresholds = {int(key): value for i, (key, value) in enumerate(params['sample']['sampling'].items()) if i >= 2}
+    return class_proportion_mask(class_counts, labels, thresholds, sample_total=params['global']['samples_size'] ** 2)
 
-def class_proportion(target):
-    prop_classes = {}
-    sample_total = (params['global']['samples_size']) ** 2
-    for i in range(0, params['global']['num_classes'] + 1):
-        prop_classes.update({str(i): 0})
-        if i in np.unique(target.flatten()):
-            prop_classes[str(i)] = (round((np.bincount(target.flatten())[i] / sample_total) * 100, 1))
-
-    condition = []
-    for i, (key, value) in enumerate(params['sample']['sampling'].items()):
-        if i >= 2 and prop_classes[key] >= value:
-            condition.append(1)
 
-    if sum(condition) == (params['global']['num_classes'] + 1):
-        return True
+def sampling_mask(class_counts, labels):
+    """Returns, for each tile of the batch, whether it satisfies all the sampling methods listed in the sampling dict"""
+    keep = np.ones(class_counts.shape[0], dtype=bool)
+    for method in params['sample']['sampling']['method']:
+        if method == 'min_annotated_percent':
+            keep &= minimum_annotated_percent(class_counts, labels, params['sample']['sampling']['map'])
+        elif method == 'class_proportion':
+            keep &= class_proportion(class_counts, labels)
+    return keep
 
-    return False
 
-
-def compute_classes(dataset, samples_file, val_percent, val_sample_file, data, target, metadata_idx, dict_classes):
+def compute_classes(dataset, samples_file, is_val, val_sample_file, data, target, metadata_idx, dict_classes,
+                    class_counts, labels):
     """ Creates Dataset (trn, val, tst) appended to Hdf5 and computes pixel classes(%) """
     val = False
-    if dataset == 'trn':
-        random_val = np.random.randint(1, 100)
-        if random_val > val_percent:
-            pass
-        else:
-            val = True
-            samples_file = val_sample_file
+    if dataset == 'trn' and is_val:
+        val = True
+        samples_file = val_sample_file
     append_to_dataset(samples_file["sat_img"], data)
     append_to_dataset(samples_file["map_img"], target)
     append_to_dataset(samples_file["meta_idx"], metadata_idx)
 
     # adds pixel count to pixel_classes dict for each class in the image
-    for i in (np.unique(target)):
-        dict_classes[i] += (np.bincount(target.flatten()))[i]
+    for i in np.flatnonzero(class_counts):
+        dict_classes[int(labels[i])] = dict_classes.get(int(labels[i]), 0) + int(class_counts[i])
 
     return val
 
@@ -157,7 +147,8 @@ def samples_preparation(in_img_array,
                         val_sample_file,
                         dataset,
                         pixel_classes,
-                        image_metadata=None):
+                        image_metadata=None,
+                        split_key=0):
     """
     Extract and write samples from input image and reference image
     :param in_img_array: numpy array of the input image
@@ -172,6 +163,7 @@ def samples_preparation(in_img_array,
     :param dataset: (str) Type of dataset where the samples will be written. Can be 'trn' or 'val' or 'tst'
     :param pixel_classes: (dict) samples pixel statistics
     :param image_metadata: (Ruamel) list of optionnal metadata specified in the associated metadata file
+    :param split_key: (int) key of the input image, used to assign its samples to trn or val (see utils.tiling)
     :return: updated samples count and number of classes.
     """
 
@@ -190,94 +182,57 @@ def samples_preparation(in_img_array,
     if image_metadata:
         # there should be one set of metadata per raster
         # ...all samples created by tiling below will point to that metadata by index
-        metadata_idx = append_to_dataset(samples_file["metadata"], repr(image_metadata))
+        metadata_idx = append_to_dataset(samples_file["metadata"], encode_metadata(image_metadata))
 
     dist_samples = round(sample_size * (1 - (overlap / 100)))
     added_samples = 0
     excl_samples = 0
 
-    with tqdm(range(0, h, dist_samples), position=1, leave=True,
+    # trn/val assignment of every sample of the image, computed at once from the sample positions
+    rows, columns = tile_origins(h, w, dist_samples)
+    val_samples = split_tiles(rows, columns, val_percent,
+                              seed=get_key_def('val_split_seed', params['sample'], 0),
+                              block_size=get_key_def('val_block_size', params['sample'], None),
+                              key=split_key)
+    label_tiles = tile_view(label_array[:, :, 0], sample_size, dist_samples)
+    ignore_index = get_key_def('ignore_index', params['training'], -1)
+
+    with tqdm(rows[:, 0], position=1, leave=True,
               desc=f'Writing samples to "{dataset}" dataset. Dataset currently contains {idx_samples} '
                    f'samples.') as _tqdm:
 
-        for row in _tqdm:
-            for column in range(0, w, dist_samples):
+        for row_idx, row in enumerate(_tqdm):
+            # class histogram and sampling criteria of the whole row of samples at once
+            targets = label_tiles[row_idx]
+            class_counts, labels = class_histogram(targets, params['global']['num_classes'] + 1, ignore_index)
+            keep = sampling_mask(class_counts, labels)
+            excl_samples += int(np.count_nonzero(~keep))
+
+            for col_idx in np.flatnonzero(keep):
+                column = columns[0, col_idx]
                 data = (in_img_array[row:row + sample_size, column:column + sample_size, :])
-                target = np.squeeze(label_array[row:row + sample_size, column:column + sample_size, :], axis=2)
                 data_row = data.shape[0]
                 data_col = data.shape[1]
                 if data_row < sample_size or data_col < sample_size:
                     data = pad_diff(data, data_row, data_col, sample_size)
 
-                target_row = target.shape[0]
-                target_col = target.shape[1]
-                if target_row < sample_size or target_col < sample_size:
-                    target = pad_diff(target, target_row, target_col, sample_size)
-                u, count = np.unique(target, return_counts=True)
-                target_background_percent = round(count[0] / np.sum(count) * 100 if 0 in u else 0, 1)
-
-                if len(params['sample']['sampling']['method']) == 1:
-                    if params['sample']['sampling']['method'][0] == 'min_annotated_percent':
-                        if minimum_annotated_percent(target_background_percent, params['sample']['sampling']['map']):
-                            val = compute_classes(dataset, samples_file, val_percent, val_sample_file,
-                                                  data, target, metadata_idx, pixel_classes)
-                            if val:
-                                idx_samples_v += 1
-                            else:
-                                idx_samples += 1
-                                added_samples += 1
-                        else:
-                            excl_samples += 1
-
-                    if params['sample']['sampling']['method'][0] == 'class_proportion':
-                        if class_proportion(target):
-                            val = compute_classes(dataset, samples_file, val_percent, val_sample_file,
-                                                  data, target, metadata_idx, pixel_classes)
-                            if val:
-                                idx_samples_v += 1
-                            else:
-                                idx_samples += 1
-                                added_samples += 1
-                        else:
-                            excl_samples += 1
-
-                if len(params['sample']['sampling']['method']) == 2:
-                    if params['sample']['sampling']['method'][0] == 'min_annotated_percent':
-                        if minimum_annotated_percent(target_background_percent, params['sample']['sampling']['map']):
-                            if params['sample']['sampling']['method'][1] == 'class_proportion':
-                                if class_proportion(target):
-                                    val = compute_classes(dataset, samples_file, val_percent, val_sample_file,
-                                                          data, target, metadata_idx, pixel_classes)
-                                    if val:
-                                        idx_samples_v += 1
-                                    else:
-                                        idx_samples += 1
-                                        added_samples += 1
-                                else:
-                                    excl_samples += 1
-
-                    elif params['sample']['sampling']['method'][0] == 'class_proportion':
-                        if class_proportion(target):
-                            if params['sample']['sampling']['method'][1] == 'min_annotated_percent':
-                                if minimum_annotated_percent(target_background_percent,
-                                                             params['sample']['sampling']['map']):
-                                    val = compute_classes(dataset, samples_file, val_percent, val_sample_file,
-                                                          data, target, metadata_idx, pixel_classes)
-                                    if val:
-                                        idx_samples_v += 1
-                                    else:
-                                        idx_samples += 1
-                                        added_samples += 1
-                                else:
-                                    excl_samples += 1
-
-                target_class_num = np.max(u)
-                if num_classes < target_class_num:
-                    num_classes = target_class_num
-
-                _tqdm.set_postfix(Excld_samples=excl_samples,
-                                  Added_samples=f'{added_samples}/{len(_tqdm) * len(range(0, w, dist_samples))}',
-                                  Target_annot_perc=100 - target_background_percent)
+                val = compute_classes(dataset, samples_file, val_samples[row_idx, col_idx], val_sample_file,
+                                      data, targets[col_idx], metadata_idx, pixel_classes,
+                                      class_counts[col_idx], labels)
+                if val:
+                    idx_samples_v += 1
+                else:
+                    idx_samples += 1
+                    added_samples += 1
+
+            target_class_num = labels[np.flatnonzero(class_counts.sum(axis=0))].max()
+            if num_classes < target_class_num:
+                num_classes = target_class_num
+
+            target_annot_perc = 100 - class_percentages(class_counts[-1:], labels, [0])[0, 0]
+            _tqdm.set_postfix(Excld_samples=excl_samples,
+                              Added_samples=f'{added_samples}/{rows.size}',
+                              Target_annot_perc=target_annot_perc)
 
     if dataset == 'tst':
         samples_count['tst'] = idx_samples
@@ -315,6 +270,7 @@ def main(params):
 
     final_samples_folder = None
     if bucket_name:
+        import boto3  # imported on first use, only needed with AWS s3 buckets
         s3 = boto3.resource('s3')
         bucket = s3.Bucket(bucket_name)
         bucket.download_file(csv_file, 'samples_prep.csv')
@@ -459,7 +415,8 @@ def main(params):
                                                                      val_file,
                                                                      info['dataset'],
                                                                      pixel_classes,
-                                                                     metadata)
+                                                                     metadata,
+                                                                     split_key=image_key(info['tif'], root=data_path))
 
                 _tqdm.set_postfix(OrderedDict(number_samples=number_samples))
                 out_file.flush()
@@ -23,10 +23,6 @@ from utils.readers import read_parameters, image_reader_as_array, read_csv
 from utils.CreateDataset import MetaSegmentationDataset
 from utils.visualization import vis, vis_from_batch
 
-try:
-    import boto3
-except ModuleNotFoundError:
-    pass
 
 
 def sem_seg_inference(model, nd_array, overlay, chunk_size, num_classes, device, meta_map=None, metadata=None, output_path=Path(os.getcwd()), index=0, debug=False):
@@ -67,6 +63,10 @@ def sem_seg_inference(model, nd_array, overlay, chunk_size, num_classes, device,
     # Create identical 0-filled array without channels dimension to receive counts for number of outputs generated in specific area.
     output_counts = np.zeros([output_probs.shape[1], output_probs.shape[2]], dtype=np.int32)
 
+    # chunks share the metadata of the image and (except at its border) their size: meta layers are computed once
+    meta_layers = MetaSegmentationDataset.get_meta_layers(meta_map, metadata, chunk_size, chunk_size) if meta_map \
+        else None
+
     if padded_array.any():
         with torch.no_grad():
             for row in tqdm(range(overlay, h + chunk_size, chunk_size - overlay), position=1, leave=False,
@@ -80,7 +80,8 @@ def sem_seg_inference(model, nd_array, overlay, chunk_size, num_classes, device,
 
                         chunk_input = padded_array[row_start:row_end, col_start:col_end, :]
                         if meta_map:
-                            chunk_input = MetaSegmentationDataset.append_meta_layers(chunk_input, meta_map, metadata)
+                            chunk_input = MetaSegmentationDataset.append_meta_layers(chunk_input, meta_map, metadata,
+                                                                                     meta_layers)
                         inputs = torch.from_numpy(np.float32(np.transpose(chunk_input, (2, 0, 1))))
 
                         inputs.unsqueeze_(0) #Add dummy batch dimension
@@ -259,6 +260,7 @@ def main(params):
         model.to(device)
 
     if bucket_name:
+        import boto3  # imported on first use, only needed with AWS s3 buckets
         s3 = boto3.resource('s3')
         bucket = s3.Bucket(bucket_name)
         if img_dir_or_csv.endswith('.csv'):
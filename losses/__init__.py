@@ -2,10 +2,9 @@
 
 import torch.nn as nn
 
-from .focal_loss import FocalLoss
+from .focal_loss import FocalLoss, PixelFocalLoss
 from .lovasz_loss import LovaszSoftmax
 from .ohem_loss import OhemCrossEntropy2d
-from .focal_loss import FocalLoss
 
 
 class MultiClassCriterion(nn.Module):
@@ -19,11 +18,15 @@ class MultiClassCriterion(nn.Module):
             self.criterion = OhemCrossEntropy2d(**kwargs)
         elif loss_type == 'Focal':
             self.criterion = FocalLoss(**kwargs)
+        elif loss_type == 'PixelFocal':
+            self.criterion = PixelFocalLoss(**kwargs)
         else:
             raise NotImplementedError\
                 (f'Current version of geo-deep-learning does not implement {loss_type} loss')
 
     def forward(self, preds, labels):
         # preds = F.interpolate(preds, labels.shape[1:], mode='bilinear', align_corners=True)
-        loss = self.criterion(preds, labels)
+        # losses are computed in fp32, even if the forward pass runs in mixed precision (sorting, exp and sums of
+        # Lovasz, Focal and OHEM losses are not reliable in fp16)
+        loss = self.criterion(preds.float(), labels)
         return loss
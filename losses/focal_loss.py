@@ -1,6 +1,7 @@
 # Source: https://www.kaggle.com/c/tgs-salt-identification-challenge/discussion/65938
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class FocalLoss(nn.Module):
@@ -20,3 +21,34 @@ class FocalLoss(nn.Module):
         loss = -((1 - pt) ** self.gamma) * logpt
 
         return loss
+
+
+class PixelFocalLoss(nn.Module):
+    """
+    Focal loss (https://arxiv.org/abs/1708.02002) computed for every pixel, then averaged over the valid pixels like
+    nn.CrossEntropyLoss (weighted mean if class weights are given). Only the log-probabilities have the size of the
+    predictions; everything else is computed on the log-probability of the true class of each pixel.
+      preds: [B, C, H, W] class logits
+      labels: [B, H, W] Tensor, ground truth labels (between 0 and C - 1)
+    """
+    def __init__(self, gamma=2, alpha=None, weight=None, ignore_index=255):
+        super().__init__()
+        self.gamma = gamma
+        self.alpha = alpha
+        self.ignore_index = ignore_index
+        self.register_buffer('weight', weight)
+
+    def forward(self, preds, labels):
+        valid = labels != self.ignore_index if self.ignore_index is not None else torch.ones_like(labels,
+                                                                                                 dtype=torch.bool)
+        labels = labels.masked_fill(~valid, 0)
+        logpt = F.log_softmax(preds, dim=1).gather(1, labels.unsqueeze(1)).squeeze(1)
+        pt = logpt.exp()
+        loss = -((1 - pt) ** self.gamma) * logpt
+        if self.alpha is not None:
+            loss = loss * self.alpha
+
+        pixel_weight = valid.to(loss.dtype)
+        if self.weight is not None:
+            pixel_weight = pixel_weight * self.weight[labels]
+        return (loss * pixel_weight).sum() / pixel_weight.sum().clamp(min=torch.finfo(loss.dtype).tiny)
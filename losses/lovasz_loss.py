@@ -1,54 +1,43 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import numpy as np
 import warnings
 
 
-def lovasz_grad(gt_sorted):
-    p = len(gt_sorted)
-    gts = gt_sorted.sum()
-    intersection = gts - gt_sorted.float().cumsum(0)
-    union = gts + (1 - gt_sorted).float().cumsum(0)
+def lovasz_grad_batched(gt_sorted):
+    """Gradient of the Lovasz extension of the Jaccard loss of many sorted ground truth vectors at once, along the last
+    dimension"""
+    gts = gt_sorted.sum(dim=-1, keepdim=True)
+    intersection = gts - gt_sorted.cumsum(dim=-1)
+    union = gts + (1 - gt_sorted).cumsum(dim=-1)
     jaccard = 1 - intersection / union
-    if p > 1:  # cover 1-pixel case
-        jaccard[1:p] = jaccard[1:p] - jaccard[0:-1]
-    return jaccard
+    return torch.cat([jaccard[..., :1], jaccard[..., 1:] - jaccard[..., :-1]], dim=-1)
 
 
-def lovasz_softmax_flat(prb, lbl, ignore_index, only_present):
+def lovasz_softmax_batched(probas, labels, ignore_index, only_present):
     """
-    Multi-class Lovasz-Softmax loss
-      probas: [P, C] Variable, class probabilities at each prediction (between 0 and 1)
-      labels: [P] Tensor, ground truth labels (between 0 and C - 1)
+    Multi-class Lovasz-Softmax loss of a whole batch, with a single sort of the errors of every (sample, class) pair.
+    Same value as the mean over the samples of the per-sample reference, lovasz_softmax_flat in benchmarks/lovasz.py.
+      probas: [B, C, H, W] Variable, class probabilities at each prediction (between 0 and 1)
+      labels: [B, H, W] Tensor, ground truth labels (between 0 and C - 1)
       only_present: average only on classes present in ground truth
     """
-    C = prb.shape[0]
-    prb = prb.permute(1, 2, 0).contiguous().view(-1, C)  # H * W, C
-    lbl = lbl.view(-1)  # H * W
-    if ignore_index is not None:
-        valid_index = lbl != ignore_index
-        if valid_index.sum() == 0:
-            return torch.mean(prb * 0)
-        prb = prb[valid_index]
-        lbl = lbl[valid_index]
+    B, C = probas.shape[:2]
+    probas = probas.reshape(B, C, -1)  # B, C, H * W
+    labels = labels.reshape(B, 1, -1)  # B, 1, H * W
+    valid = labels != ignore_index if ignore_index is not None else torch.ones_like(labels, dtype=torch.bool)
+
+    fg = ((labels == torch.arange(C, device=labels.device).view(1, C, 1)) & valid).to(probas.dtype)
+    # ignored pixels get a negative error, so they are sorted last and do not change the gradient of valid ones
+    errors = torch.where(valid, (fg - probas).abs(), torch.full_like(probas, -1))
+    errors_sorted, perm = torch.sort(errors, dim=-1, descending=True)
+    fg_sorted = fg.gather(-1, perm)
+    losses = (errors_sorted.clamp(min=0) * lovasz_grad_batched(fg_sorted)).sum(dim=-1)  # B, C
 
-    total_loss = 0
-    cnt = 0
-    for c in range(C):
-        fg = (lbl == c).float()  # foreground for class c
-        if only_present and fg.sum() == 0:
-            continue
-        errors = (fg - prb[:, c]).abs()
-        errors_sorted, perm = torch.sort(errors, dim=0, descending=True)
-        perm = perm.data
-        fg_sorted = fg[perm]
-        total_loss += torch.dot(errors_sorted, lovasz_grad(fg_sorted))
-        cnt += 1
-    try:
-        return total_loss / cnt
-    except:
-        pass
+    present = fg.sum(dim=-1) > 0 if only_present else torch.ones_like(losses, dtype=torch.bool)
+    count = present.sum(dim=1)
+    sample_losses = (losses * present).sum(dim=1) / count.clamp(min=1)  # 0 for samples without any class to average
+    return sample_losses.sum() / B
 
 
 class LovaszSoftmax(nn.Module):
@@ -71,8 +60,4 @@ class LovaszSoftmax(nn.Module):
 
     def forward(self, logits, labels):
         probas = F.softmax(logits, dim=1)
-        total_loss = 0
-        batch_size = logits.shape[0]
-        for prb, lbl in zip(probas, labels):
-            total_loss += lovasz_softmax_flat(prb, lbl, self.ignore_index, self.only_present)
-        return total_loss / batch_size
+        return lovasz_softmax_batched(probas, labels, self.ignore_index, self.only_present)
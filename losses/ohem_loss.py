@@ -1,17 +1,21 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import numpy as np
 
 
 # Adapted from OCNet Repository (https://github.com/PkuRainBow/OCNet)
 class OhemCrossEntropy2d(nn.Module):
+    """
+    Online hard example mining cross entropy: only pixels whose predicted probability for their true class is at most
+    thresh contribute to the loss. If min_kept is set, the threshold is raised so that at least the min_kept hardest
+    valid pixels are kept. Computed on the device of the predictions, without copies to the CPU.
+    """
     def __init__(self, thresh=0.6, min_kept=0, weight=None, ignore_index=255):
         super().__init__()
         self.ignore_label = ignore_index
         self.thresh = float(thresh)
         self.min_kept = int(min_kept)
-        self.criterion = nn.CrossEntropyLoss(weight=weight, ignore_index=ignore_index)
+        self.criterion = nn.NLLLoss(weight=weight, ignore_index=ignore_index)
 
     def forward(self, predict, target):
         """
@@ -19,36 +23,18 @@ class OhemCrossEntropy2d(nn.Module):
                 predict:(n, c, h, w)
                 target:(n, h, w)
         """
+        log_prob = F.log_softmax(predict, dim=1)
 
-        n, c, h, w = predict.size()
-        input_label = target.data.cpu().numpy().ravel().astype(np.int32)
-        x = np.rollaxis(predict.data.cpu().numpy(), 1).reshape((c, -1))
-        input_prob = np.exp(x - x.max(axis=0).reshape((1, -1)))
-        input_prob /= input_prob.sum(axis=0).reshape((1, -1))
-
-        valid_flag = input_label != self.ignore_label
-        valid_inds = np.where(valid_flag)[0]
-        label = input_label[valid_flag]
-        num_valid = valid_flag.sum()
-        if self.min_kept >= num_valid:
-            print('Labels: {}'.format(num_valid))
-        elif num_valid > 0:
-            prob = input_prob[:, valid_flag]
-            pred = prob[label, np.arange(len(label), dtype=np.int32)]
-            threshold = self.thresh
+        with torch.no_grad():
+            valid = target != self.ignore_label
+            # probability of the true class; ignored pixels get inf, so they are never counted as hard examples
+            pred = log_prob.gather(1, target.masked_fill(~valid, 0).unsqueeze(1)).squeeze(1).exp()
+            pred = pred.masked_fill(~valid, float('inf'))
+            threshold = torch.tensor(self.thresh, device=pred.device)
             if self.min_kept > 0:
-                index = pred.argsort()
-                threshold_index = index[min(len(index), self.min_kept) - 1]
-                if pred[threshold_index] > self.thresh:
-                    threshold = pred[threshold_index]
-            kept_flag = pred <= threshold
-            valid_inds = valid_inds[kept_flag]
-            #print('hard ratio: {} = {} / {} '.format(round(len(valid_inds)/num_valid, 4), len(valid_inds), num_valid))
-
-        label = input_label[valid_inds].copy()
-        input_label.fill(self.ignore_label)
-        input_label[valid_inds] = label
-        #print(np.sum(input_label != self.ignore_label))
-        target = torch.from_numpy(input_label.reshape(target.size())).long().cuda()
+                # inf if min_kept >= number of valid pixels, in which case all of them are kept
+                kth_pred = pred.view(-1).kthvalue(min(self.min_kept, pred.numel())).values
+                threshold = torch.max(threshold, kth_pred)
+            kept = valid & (pred <= threshold)
 
-        return self.criterion(predict, target)
+        return self.criterion(log_prob, target.masked_fill(~kept, self.ignore_label))
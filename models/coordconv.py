@@ -24,7 +24,11 @@ def get_coords_map(height, width, centered=True, normalized=True, noise=None, dt
 
 
 class AddCoords(torch.nn.Module):
-    """Creates a torch-compatible layer that adds intrinsic coordinate layers to input tensors."""
+    """Creates a torch-compatible layer that adds intrinsic coordinate layers to input tensors.
+
+    Coordinate maps (and radius channel) are computed once per input height, width, device and dtype, then cached and
+    expanded across the batch without copies. With noise, only the noise term is drawn again at every forward pass.
+    """
     def __init__(self, centered=True, normalized=True, noise=None, radius_channel=False, scale=None):
         super().__init__()
         self.centered = centered
@@ -32,20 +36,35 @@ class AddCoords(torch.nn.Module):
         self.noise = noise
         self.radius_channel = radius_channel
         self.scale = None
+        self.coords_cache = {}  # (height, width, device, dtype) -> coordinates map, not saved with the state dict
+
+    def radius(self, coords_map, height, width):
+        middle_slice = coords_map[:, (height - 1) // 2, (width - 1) // 2]
+        return torch.sqrt(torch.pow(coords_map[0, :, :] - middle_slice[0], 2) +
+                          torch.pow(coords_map[1, :, :] - middle_slice[1], 2))
+
+    def get_coords(self, height, width, device, dtype):
+        """Returns the cached coordinates map (shape=2xHxW, or 3xHxW with the radius channel) of an input size"""
+        key = (height, width, device, dtype)
+        if key not in self.coords_cache:
+            coords_map = get_coords_map(height, width, self.centered, self.normalized)
+            if self.scale is not None:
+                coords_map *= self.scale
+            if self.radius_channel and self.noise is None:
+                coords_map = torch.cat([coords_map, self.radius(coords_map, height, width).unsqueeze(0)], dim=0)
+            self.coords_cache[key] = coords_map.to(device=device, dtype=dtype)
+        return self.coords_cache[key]
 
     def forward(self, in_tensor):
         batch_size, channels, height, width = in_tensor.shape
-        coords_map = get_coords_map(height, width, self.centered, self.normalized, self.noise)
-        if self.scale is not None:
-            coords_map *= self.scale
-        if self.radius_channel:
-            middle_slice = coords_map[:, (height - 1) // 2, (width - 1) // 2]
-            radius = torch.sqrt(torch.pow(coords_map[0, :, :] - middle_slice[0], 2) +
-                                torch.pow(coords_map[1, :, :] - middle_slice[1], 2))
-            coords_map = torch.cat([coords_map, radius.unsqueeze(0)], dim=0)
-        coords_map = coords_map.repeat(batch_size, 1, 1, 1)
-        dev = in_tensor.device
-        out = torch.cat([in_tensor, coords_map.to(dev)], dim=1)
+        coords_map = self.get_coords(height, width, in_tensor.device, in_tensor.dtype)
+        if self.noise is not None:
+            assert isinstance(self.noise, float) and self.noise >= 0, "invalid noise stddev value"
+            coords_map = coords_map + torch.randn_like(coords_map) * self.noise
+            if self.radius_channel:
+                coords_map = torch.cat([coords_map, self.radius(coords_map, height, width).unsqueeze(0)], dim=0)
+        coords_map = coords_map.unsqueeze(0).expand(batch_size, -1, -1, -1)
+        out = torch.cat([in_tensor, coords_map], dim=1)
         return out
 
 
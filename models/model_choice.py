@@ -37,11 +37,13 @@ def net(net_params, num_channels, inference=False):
     pretrained = get_key_def('pretrained', net_params['training'], True) if not inference else False
     dropout = get_key_def('dropout', net_params['training'], False)
     dropout_prob = get_key_def('dropout_prob', net_params['training'], 0.5)
+    # activation checkpointing only saves memory during training
+    checkpoint_stages = get_key_def('checkpoint_stages', net_params['training'], None) if not inference else None
 
     if model_name == 'unetsmall':
-        model = unet.UNetSmall(num_channels, num_bands, dropout, dropout_prob)
+        model = unet.UNetSmall(num_channels, num_bands, dropout, dropout_prob, checkpoint_stages)
     elif model_name == 'unet':
-        model = unet.UNet(num_channels, num_bands, dropout, dropout_prob)
+        model = unet.UNet(num_channels, num_bands, dropout, dropout_prob, checkpoint_stages)
     elif model_name == 'ternausnet':
         assert num_bands == 3, msg
         model = TernausNet.ternausnet(num_channels)
@@ -57,11 +59,11 @@ def net(net_params, num_channels, inference=False):
         assert (num_bands == 3 or num_bands == 4), msg
         if num_bands == 3:
             print('Finetuning pretrained deeplabv3 with 3 bands')
-            model = models.segmentation.deeplabv3_resnet101(pretrained=True, progress=True, aux_loss=None)
+            model = models.segmentation.deeplabv3_resnet101(pretrained=pretrained, progress=True, aux_loss=None)
             model.classifier = common.DeepLabHead(2048, num_channels)
         elif num_bands == 4:
             print('Finetuning pretrained deeplabv3 with 4 bands')
-            model = models.segmentation.deeplabv3_resnet101(pretrained=True, progress=True, aux_loss=None)
+            model = models.segmentation.deeplabv3_resnet101(pretrained=pretrained, progress=True, aux_loss=None)
             conv1 = model.backbone._modules['conv1'].weight.detach().numpy()
             depth = np.random.uniform(low=-1, high=1, size=(64, 1, 7, 7))
             conv1 = np.append(conv1, depth, axis=1)
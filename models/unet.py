@@ -1,6 +1,9 @@
+from contextlib import contextmanager
+
 import torch
 from utils import utils
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 
 class EncodingBlock(nn.Module):
@@ -62,11 +65,78 @@ class DecodingBlock(nn.Module):
         return self.conv(torch.cat([output1, output2], 1))
 
 
-class UNet(nn.Module):
+@contextmanager
+def frozen_batch_norm_stats(module):
+    """Restores the running statistics of the batch norm layers of module on exit, so that they are not updated twice
+    when a checkpointed stage is recomputed during the backward pass"""
+    batch_norms = [m for m in module.modules() if isinstance(m, nn.BatchNorm2d) and m.track_running_stats]
+    saved = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in batch_norms]
+    try:
+        yield
+    finally:
+        for m, (mean, var, num_batches) in zip(batch_norms, saved):
+            m.running_mean.copy_(mean)
+            m.running_var.copy_(var)
+            m.num_batches_tracked.copy_(num_batches)
+
+
+class CheckpointedStages(nn.Module):
+    """
+    Base of the UNet architectures, running some of their stages (encoding or decoding blocks) with activation
+    checkpointing: activations inside a checkpointed stage are not kept for the backward pass, but recomputed from the
+    input of the stage, which trades compute for memory. Batch norm running statistics are only updated by the forward
+    pass, not by the recompute, so they match the ones of the model without checkpointing.
+    """
+    encoder_stages = ()
+    decoder_stages = ()
+
+    def set_checkpoint_stages(self, checkpoint_stages=None):
+        """
+        :param checkpoint_stages: (str or list) 'all', 'encoder', 'decoder' or list of names of stages (ex.: conv1,
+                                  center, decode1) to checkpoint. None or empty to checkpoint nothing.
+        """
+        shortcuts = {'all': self.encoder_stages + self.decoder_stages,
+                     'encoder': self.encoder_stages,
+                     'decoder': self.decoder_stages}
+        if isinstance(checkpoint_stages, str):
+            checkpoint_stages = [checkpoint_stages]
+        stages = set()
+        for stage in checkpoint_stages or []:
+            if stage in shortcuts:
+                stages.update(shortcuts[stage])
+            elif stage in self.encoder_stages + self.decoder_stages:
+                stages.add(stage)
+            else:
+                raise ValueError(f'Unknown stage {stage} to checkpoint in {type(self).__name__}. Expected one of '
+                                 f'{list(shortcuts) + list(self.encoder_stages + self.decoder_stages)}')
+        self.checkpoint_stages = stages
+
+    def run_stage(self, name, *inputs):
+        """Runs the stage with the given name, checkpointed if it was set to be and gradients are computed"""
+        stage = getattr(self, name)
+        if name in self.checkpoint_stages and torch.is_grad_enabled():
+            calls = []
+
+            def run(*stage_inputs):
+                # the first call is the forward pass, the next ones recompute it for the backward pass
+                if not calls:
+                    calls.append(name)
+                    return stage(*stage_inputs)
+                with frozen_batch_norm_stats(stage):
+                    return stage(*stage_inputs)
+
+            return checkpoint(run, *inputs, use_reentrant=False)
+        return stage(*inputs)
+
+
+class UNet(CheckpointedStages):
     """Main UNet architecture"""
+    encoder_stages = ('conv1', 'conv2', 'conv3', 'conv4', 'center')
+    decoder_stages = ('decode4', 'decode3', 'decode2', 'decode1')
 
-    def __init__(self, num_classes, number_of_bands, dropout=False, prob=0.5):
+    def __init__(self, num_classes, number_of_bands, dropout=False, prob=0.5, checkpoint_stages=None):
         super().__init__()
+        self.set_checkpoint_stages(checkpoint_stages)
 
         self.conv1 = EncodingBlock(number_of_bands, 64, dropout=dropout, prob=prob)
         self.maxpool1 = nn.MaxPool2d(kernel_size=2)
@@ -87,32 +157,35 @@ class UNet(nn.Module):
         self.final = nn.Conv2d(64, num_classes, kernel_size=1)
 
     def forward(self, input_data):
-        conv1 = self.conv1(input_data)
+        conv1 = self.run_stage('conv1', input_data)
         maxpool1 = self.maxpool1(conv1)
-        conv2 = self.conv2(maxpool1)
+        conv2 = self.run_stage('conv2', maxpool1)
         maxpool2 = self.maxpool2(conv2)
-        conv3 = self.conv3(maxpool2)
+        conv3 = self.run_stage('conv3', maxpool2)
         maxpool3 = self.maxpool3(conv3)
-        conv4 = self.conv4(maxpool3)
+        conv4 = self.run_stage('conv4', maxpool3)
         maxpool4 = self.maxpool4(conv4)
 
-        center = self.center(maxpool4)
+        center = self.run_stage('center', maxpool4)
 
-        decode4 = self.decode4(conv4, center)
-        decode3 = self.decode3(conv3, decode4)
-        decode2 = self.decode2(conv2, decode3)
-        decode1 = self.decode1(conv1, decode2)
+        decode4 = self.run_stage('decode4', conv4, center)
+        decode3 = self.run_stage('decode3', conv3, decode4)
+        decode2 = self.run_stage('decode2', conv2, decode3)
+        decode1 = self.run_stage('decode1', conv1, decode2)
 
         final = nn.functional.interpolate(self.final(decode1), input_data.size()[2:], mode='bilinear', align_corners=True)
 
         return final
 
 
-class UNetSmall(nn.Module):
+class UNetSmall(CheckpointedStages):
     """Main UNet architecture"""
+    encoder_stages = ('conv1', 'conv2', 'conv3', 'center')
+    decoder_stages = ('decode3', 'decode2', 'decode1')
 
-    def __init__(self, num_classes, number_of_bands, dropout=False, prob=0.5):
+    def __init__(self, num_classes, number_of_bands, dropout=False, prob=0.5, checkpoint_stages=None):
         super().__init__()
+        self.set_checkpoint_stages(checkpoint_stages)
 
         self.conv1 = EncodingBlock(number_of_bands, 32, dropout=dropout, prob=prob)
         self.maxpool1 = nn.MaxPool2d(kernel_size=2)
@@ -130,18 +203,18 @@ class UNetSmall(nn.Module):
         self.final = nn.Conv2d(32, num_classes, kernel_size=1)
 
     def forward(self, input_data):
-        conv1 = self.conv1(input_data)
+        conv1 = self.run_stage('conv1', input_data)
         maxpool1 = self.maxpool1(conv1)
-        conv2 = self.conv2(maxpool1)
+        conv2 = self.run_stage('conv2', maxpool1)
         maxpool2 = self.maxpool2(conv2)
-        conv3 = self.conv3(maxpool2)
+        conv3 = self.run_stage('conv3', maxpool2)
         maxpool3 = self.maxpool3(conv3)
 
-        center = self.center(maxpool3)
+        center = self.run_stage('center', maxpool3)
 
-        decode3 = self.decode3(conv3, center)
-        decode2 = self.decode2(conv2, decode3)
-        decode1 = self.decode1(conv1, decode2)
+        decode3 = self.run_stage('decode3', conv3, center)
+        decode2 = self.run_stage('decode2', conv2, decode3)
+        decode1 = self.run_stage('decode1', conv1, decode2)
 
         final = nn.functional.interpolate(self.final(decode1), input_data.size()[2:], mode='bilinear', align_corners=True)
 
@@ -16,11 +16,6 @@ import shutil
 import numpy as np
 
 
-try:
-    from pynvml import *
-except ModuleNotFoundError:
-    warnings.warn(f"The python Nvidia management library could not be imported. Ignore if running on CPU only.")
-
 import torchvision
 import torch.optim as optim
 from torch import nn
@@ -31,7 +26,7 @@ from PIL import Image
 from utils import augmentation as aug, CreateDataset
 from utils.optimizer import create_optimizer
 from utils.logger import InformationLogger, save_logs_to_bucket, tsv_line
-from utils.metrics import report_classification, create_metrics_dict
+from utils.metrics import report_classification, create_metrics_dict, ConfusionMatrix
 from models.model_choice import net, load_checkpoint
 from losses import MultiClassCriterion
 from utils.utils import load_from_checkpoint, list_s3_subfolders, get_device_ids, gpu_stats, \
@@ -39,11 +34,6 @@ from utils.utils import load_from_checkpoint, list_s3_subfolders, get_device_ids
 from utils.visualization import vis, vis_from_batch
 from utils.readers import read_parameters
 
-try:
-    import boto3
-except ModuleNotFoundError:
-    warnings.warn('The boto3 library counldn\'t be imported. Ignore if not using AWS s3 buckets', ImportWarning)
-    pass
 
 
 def verify_weights(num_classes, weights):
@@ -128,6 +118,7 @@ def download_s3_files(bucket_name, data_path, output_path, num_classes):
         os.mkdir(output_path)
     except FileExistsError:
         pass
+    import boto3  # imported on first use, only needed with AWS s3 buckets
     s3 = boto3.resource('s3')
     bucket = s3.Bucket(bucket_name)
 
@@ -479,6 +470,8 @@ def evaluation(eval_loader, model, criterion, num_classes, batch_size, ep_idx, p
     :return: (dict) eval_metrics
     """
     eval_metrics = create_metrics_dict(num_classes)
+    confusion_matrix = ConfusionMatrix(num_classes, ignore_index=get_key_def("ignore_index", params["training"], None),
+                                       device=device)
     model.eval()
 
     with tqdm(eval_loader, dynamic_ncols=True, desc=f'Iterating {dataset} batches with {device.type}') as _tqdm:
@@ -499,17 +492,15 @@ def evaluation(eval_loader, model, criterion, num_classes, batch_size, ep_idx, p
                 eval_metrics['loss'].update(loss.item(), batch_size)
 
                 if (dataset == 'val') and (batch_metrics is not None):
-                    # Compute metrics every n batches. Time consuming.
+                    # Accumulate metrics every n batches.
                     assert batch_metrics <= len(_tqdm), f"Batch_metrics ({batch_metrics} is smaller than batch size " \
                         f"{len(_tqdm)}. Metrics in validation loop won't be computed"
                     if (batch_index+1) % batch_metrics == 0:   # +1 to skip val loop at very beginning
                         a, segmentation = torch.max(outputs_flatten, dim=1)
-                        eval_metrics = report_classification(segmentation, labels_flatten, batch_size, eval_metrics,
-                                                             ignore_index=get_key_def("ignore_index", params["training"], None))
+                        confusion_matrix.update(segmentation, labels_flatten)
                 elif dataset == 'tst':
                     a, segmentation = torch.max(outputs_flatten, dim=1)
-                    eval_metrics = report_classification(segmentation, labels_flatten, batch_size, eval_metrics,
-                                                         ignore_index=get_key_def("ignore_index", params["training"], None))
+                    confusion_matrix.update(segmentation, labels_flatten)
 
                 _tqdm.set_postfix(OrderedDict(dataset=dataset, loss=f'{eval_metrics["loss"].avg:.4f}'))
 
@@ -518,11 +509,15 @@ def evaluation(eval_loader, model, criterion, num_classes, batch_size, ep_idx, p
                     _tqdm.set_postfix(OrderedDict(device=device, gpu_perc=f'{res.gpu} %',
                                                   gpu_RAM=f'{mem.used/(1024**2):.0f}/{mem.total/(1024**2):.0f} MiB'))
 
+    if (dataset == 'val' and batch_metrics is not None) or dataset == 'tst':
+        eval_metrics = report_classification(confusion_matrix, eval_metrics)
+
     print(f"{dataset} Loss: {eval_metrics['loss'].avg}")
     if batch_metrics is not None:
         print(f"{dataset} precision: {eval_metrics['precision'].avg}")
         print(f"{dataset} recall: {eval_metrics['recall'].avg}")
         print(f"{dataset} fscore: {eval_metrics['fscore'].avg}")
+        print(f"{dataset} iou: {eval_metrics['iou'].avg}")
 
     return eval_metrics
 
@@ -9,6 +9,7 @@ import h5py
 import datetime
 import warnings
 import functools
+import contextlib
 
 from tqdm import tqdm
 from collections import OrderedDict
@@ -16,22 +17,22 @@ import shutil
 import numpy as np
 
 
-try:
-    from pynvml import *
-except ModuleNotFoundError:
-    warnings.warn(f"The python Nvidia management library could not be imported. Ignore if running on CPU only.")
-
 import torchvision
 import torch.optim as optim
 from torch import nn
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 from torchvision import transforms
 from PIL import Image
 
 from utils import augmentation as aug, CreateDataset
 from utils.optimizer import create_optimizer
-from utils.logger import InformationLogger, save_logs_to_bucket, tsv_line
-from utils.metrics import report_classification, create_metrics_dict
+from utils.logger import InformationLogger, RunLogger, save_logs_to_bucket
+from utils.prefetch import DevicePrefetcher
+from utils.metrics import report_classification, create_metrics_dict, ConfusionMatrix, LossMeter
+from utils.distributed import init_distributed, is_distributed, get_rank, get_world_size, get_local_rank, \
+    is_main_process, barrier, broadcast_object, cleanup, ShardSampler
 from models.model_choice import net, load_checkpoint
 from losses import MultiClassCriterion
 from utils.utils import load_from_checkpoint, list_s3_subfolders, get_device_ids, gpu_stats, \
@@ -39,11 +40,6 @@ from utils.utils import load_from_checkpoint, list_s3_subfolders, get_device_ids
 from utils.visualization import vis, vis_from_batch
 from utils.readers import read_parameters
 
-try:
-    import boto3
-except ModuleNotFoundError:
-    warnings.warn('The boto3 library counldn\'t be imported. Ignore if not using AWS s3 buckets', ImportWarning)
-    pass
 
 
 def verify_weights(num_classes, weights):
@@ -72,6 +68,72 @@ def flatten_outputs(predictions, number_of_classes):
     return outputs_flatten
 
 
+def get_autocast_dtype(precision, device):
+    """
+    Returns the dtype of the automatic mixed precision mode.
+    :param precision: (str) One of fp32, fp16 or bf16
+    :param device: device used by pytorch (cpu ou cuda)
+    :return: (torch.dtype) autocast dtype, or None for full fp32 precision
+    """
+    dtypes = {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+    if precision not in dtypes:
+        raise ValueError(f'Precision should be one of {list(dtypes.keys())}. Got {precision}')
+    if precision == 'fp16' and device.type != 'cuda':
+        warnings.warn('fp16 mixed precision requires a cuda device. Using bf16 on cpu.')
+        precision = 'bf16'
+    return dtypes[precision]
+
+
+def probe_micro_batch_size(model, criterion, sample, max_batch_size, device, amp_dtype=None):
+    """
+    Finds the largest micro-batch that fits in memory for a training step (forward and backward pass), by halving the
+    batch size from max_batch_size until no out of memory error is raised. The batch norm buffers of the model are
+    restored after the probe and the gradients are cleared.
+    :param model: model to train (not wrapped in DistributedDataParallel)
+    :param criterion: loss criterion
+    :param sample: (dict) one sample of the training dataset, with 'sat_img' and 'map_img' tensors
+    :param max_batch_size: (int) largest batch size to try
+    :param device: device used by pytorch (cpu ou cuda)
+    :param amp_dtype: (torch.dtype) dtype of the automatic mixed precision forward pass. If None, full fp32 precision
+    :return: (int) largest micro-batch size that fits in memory
+    """
+    buffers = {name: buffer.clone() for name, buffer in model.named_buffers()}
+    model.train()
+    batch_size = max_batch_size
+    while batch_size > 1:
+        try:
+            inputs = sample['sat_img'].unsqueeze(0).expand(batch_size, *sample['sat_img'].shape).to(device)
+            labels = sample['map_img'].unsqueeze(0).expand(batch_size, *sample['map_img'].shape).to(device)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                outputs = model(inputs)
+            if isinstance(outputs, OrderedDict):
+                outputs = outputs['out']
+            criterion(outputs, labels.long()).backward()
+            break
+        except RuntimeError as error:
+            if 'out of memory' not in str(error):
+                raise
+            batch_size //= 2
+        finally:
+            inputs = labels = outputs = None
+            model.zero_grad()
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
+
+    with torch.no_grad():
+        for name, buffer in model.named_buffers():
+            buffer.copy_(buffers[name])
+    return batch_size
+
+
+def print_timings(data_loader, dataset):
+    """Prints the time spent waiting for data and computing during the last iteration of a DevicePrefetcher"""
+    if isinstance(data_loader, DevicePrefetcher):
+        total = max(data_loader.wait_time + data_loader.compute_time, 1e-9)
+        print(f'{dataset} data wait: {data_loader.wait_time:.1f}s ({data_loader.wait_time / total:.0%}), '
+              f'compute: {data_loader.compute_time:.1f}s')
+
+
 def loader(path):
     img = Image.open(path)
     return img
@@ -93,6 +155,7 @@ def download_s3_files(bucket_name, data_path, output_path):
         os.mkdir(output_path)
     except FileExistsError:
         pass
+    import boto3  # imported on first use, only needed with AWS s3 buckets
     s3 = boto3.resource('s3')
     bucket = s3.Bucket(bucket_name)
 
@@ -107,7 +170,7 @@ def download_s3_files(bucket_name, data_path, output_path):
     return bucket, bucket_output_path, local_output_path, data_path
 
 
-def create_dataloader(data_path, batch_size, task, num_devices, params, samples_folder=None):
+def create_dataloader(data_path, batch_size, task, num_devices, params, samples_folder=None, device=None):
     """
     Function to create dataloader objects for training, validation and test datasets.
     :param data_path: (str) path to the samples folder
@@ -116,6 +179,8 @@ def create_dataloader(data_path, batch_size, task, num_devices, params, samples_
     :param num_devices: (int) number of GPUs used
     :param samples_folder: path to folder containting .hdf5 files if task is segmentation
     :param params: (dict) Parameters found in the yaml config file.
+    :param device: device used by pytorch (cpu ou cuda). If given, dataloaders are wrapped in a DevicePrefetcher that
+                   copies the next batch to the device while the current one is processed.
     :return: trn_dataloader, val_dataloader, tst_dataloader
     """
     assert Path(samples_folder).is_dir(), f'Could not locate: {samples_folder}'
@@ -146,13 +211,29 @@ def create_dataloader(data_path, batch_size, task, num_devices, params, samples_
     # https://discuss.pytorch.org/t/guidelines-for-assigning-num-workers-to-dataloader/813/5
     num_workers = num_devices * 4 if num_devices > 1 else 4
 
+    # In distributed mode, each process loads its own shard of the datasets. batch_size is then per process.
+    # val and tst shards are not padded, so that every sample is evaluated exactly once over all processes.
+    samplers = {subset: (DistributedSampler(dataset, shuffle=True) if subset == 'trn' else ShardSampler(dataset))
+                if is_distributed() else None
+                for subset, dataset in zip(["trn", "val", "tst"], datasets)}
+
+    # pinned memory allows asynchronous copies to cuda devices
+    pin_memory = device is not None and device.type == 'cuda'
+
     # Shuffle must be set to True.
-    trn_dataloader = DataLoader(trn_dataset, batch_size=batch_size, num_workers=num_workers, shuffle=True,
-                                drop_last=True)
+    trn_dataloader = DataLoader(trn_dataset, batch_size=batch_size, num_workers=num_workers,
+                                shuffle=samplers['trn'] is None, sampler=samplers['trn'], drop_last=True,
+                                pin_memory=pin_memory, collate_fn=aug.collate_samples)
     val_dataloader = DataLoader(val_dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False,
-                                drop_last=True)
+                                sampler=samplers['val'], drop_last=False, pin_memory=pin_memory,
+                                collate_fn=aug.collate_samples)
     tst_dataloader = DataLoader(tst_dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False,
-                                drop_last=True) if num_samples['tst'] > 0 else None
+                                sampler=samplers['tst'], drop_last=False, pin_memory=pin_memory,
+                                collate_fn=aug.collate_samples) if num_samples['tst'] > 0 else None
+
+    if device is not None:
+        trn_dataloader, val_dataloader = DevicePrefetcher(trn_dataloader, device), DevicePrefetcher(val_dataloader, device)
+        tst_dataloader = DevicePrefetcher(tst_dataloader, device) if tst_dataloader else None
 
     return trn_dataloader, val_dataloader, tst_dataloader
 
@@ -231,6 +312,12 @@ def main(params, config_path):
     if debug:
         warnings.warn(f'Debug mode activated. Some debug features may mobilize extra disk space and cause delays in execution.')
 
+    # Distributed mode when launched with torchrun and more than one process, e.g.:
+    # torchrun --nproc_per_node=2 train_segmentation.py config.yaml
+    distributed = init_distributed(backend=get_key_def('dist_backend', params['training'], 'gloo'))
+    if distributed:
+        tqdm.write(f'Distributed training: process {get_rank()} of {get_world_size()}\n')
+
     now = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M")
     num_classes = params['global']['num_classes']
     task = params['global']['task']
@@ -253,15 +340,19 @@ def main(params, config_path):
 
     modelname = config_path.stem
     output_path = Path(samples_folder).joinpath('model') / modelname
-    if output_path.is_dir():
-        output_path = Path(str(output_path)+'_'+now)
-    output_path.mkdir(parents=True, exist_ok=False)
-    shutil.copy(str(config_path), str(output_path))
-    tqdm.write(f'Model and log files will be saved to: {output_path}\n\n')
+    # only the main process creates the output folder, the other ones write in the same folder
+    if is_main_process():
+        if output_path.is_dir():
+            output_path = Path(str(output_path)+'_'+now)
+        output_path.mkdir(parents=True, exist_ok=False)
+        shutil.copy(str(config_path), str(output_path))
+        tqdm.write(f'Model and log files will be saved to: {output_path}\n\n')
+    output_path = broadcast_object(output_path)
     task = params['global']['task']
     batch_size = params['training']['batch_size']
 
     if bucket_name:
+        assert not distributed, 'S3 buckets are not supported in distributed mode'
         bucket, bucket_output_path, output_path, data_path = download_s3_files(bucket_name=bucket_name,
                                                                                data_path=data_path,
                                                                                output_path=output_path)
@@ -270,22 +361,33 @@ def main(params, config_path):
     best_loss = 999
     last_vis_epoch = 0
 
-    progress_log = Path(output_path) / 'progress.log'
-    if not progress_log.exists():
-        progress_log.open('w', buffering=1).write(tsv_line('ep_idx', 'phase', 'iter', 'i_p_ep', 'time'))  # Add header
+    # one progress log per process
+    progress_log = Path(output_path) / ('progress.log' if is_main_process() else f'progress_rank{get_rank()}.log')
+    # optional structured log of progress and metric records, one json object per line
+    jsonl_log = progress_log.with_suffix('.jsonl') if get_key_def('log_jsonl', params['training'], False) else None
+    run_logger = RunLogger(progress_log, jsonl_log)
+    # loss and debug statistics are read from the device every sync_every batches only
+    sync_every = get_key_def('sync_every', params['training'], 50)
 
-    trn_log = InformationLogger(output_path, 'trn')
-    val_log = InformationLogger(output_path, 'val')
-    tst_log = InformationLogger(output_path, 'tst')
+    if is_main_process():
+        trn_log = InformationLogger(output_path, 'trn', run_logger)
+        val_log = InformationLogger(output_path, 'val', run_logger)
+        tst_log = InformationLogger(output_path, 'tst', run_logger)
 
     num_devices = params['global']['num_gpus']
     assert num_devices is not None and num_devices >= 0, "missing mandatory num gpus parameter"
     # list of GPU devices that are available and unused. If no GPUs, returns empty list
-    lst_device_ids = get_device_ids(num_devices) if torch.cuda.is_available() else []
+    if distributed:
+        # one device per process, picked by torchrun's local rank
+        lst_device_ids = [get_local_rank()] if torch.cuda.is_available() and num_devices > 0 else []
+    else:
+        lst_device_ids = get_device_ids(num_devices) if torch.cuda.is_available() else []
     num_devices = len(lst_device_ids) if lst_device_ids else 0
     device = torch.device(f'cuda:{lst_device_ids[0]}' if torch.cuda.is_available() and lst_device_ids else 'cpu')
     print(f"Number of cuda devices requested: {params['global']['num_gpus']}. Cuda devices available: {lst_device_ids}\n")
-    if num_devices == 1:
+    if distributed:
+        print(f"Using distributed data parallel on device {device}\n")
+    elif num_devices == 1:
         print(f"Using Cuda device {lst_device_ids[0]}\n")
     elif num_devices > 1:
         print(f"Using data parallel on devices: {str(lst_device_ids)[1:-1]}. Main device: {lst_device_ids[0]}\n") # TODO: why are we showing indices [1:-1] for lst_device_ids?
@@ -307,7 +409,8 @@ def main(params, config_path):
                                                                        task=task,
                                                                        num_devices=num_devices,
                                                                        params=params,
-                                                                       samples_folder=samples_folder)
+                                                                       samples_folder=samples_folder,
+                                                                       device=device)
 
     tqdm.write(f'Setting model, criterion, optimizer and learning rate scheduler...\n')
     try:  # For HPC when device 0 not available. Error: Cuda invalid device ordinal.
@@ -317,9 +420,49 @@ def main(params, config_path):
         device = torch.device(f'cuda:0' if torch.cuda.is_available() and lst_device_ids else 'cpu')
         model.to(device)
     model, criterion, optimizer, lr_scheduler = set_hyperparameters(params, num_classes_corrected, model, checkpoint)
+    if distributed:
+        # DistributedDataParallel adds prefix 'module.' to state_dict keys
+        model = DistributedDataParallel(model, device_ids=lst_device_ids if lst_device_ids else None)
 
     criterion = criterion.to(device)
 
+    # Automatic mixed precision. Gradients are only scaled in fp16, bf16 has the range of fp32.
+    amp_dtype = get_autocast_dtype(get_key_def('precision', params['training'], 'fp32'), device)
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+
+    # Gradient accumulation: batch_size samples per optimizer step, loaded in micro-batches of micro_batch_size
+    micro_batch_size = get_key_def('micro_batch_size', params['training'], None)
+    if micro_batch_size == 'auto':
+        if device.type == 'cuda':
+            micro_batch_size = probe_micro_batch_size(model.module if distributed else model, criterion,
+                                                      trn_dataloader.dataset[0], batch_size, device, amp_dtype)
+            if distributed:  # all processes must accumulate the same number of micro-batches
+                micro_batch_size = torch.tensor(micro_batch_size, device=device)
+                torch.distributed.all_reduce(micro_batch_size, op=torch.distributed.ReduceOp.MIN)
+                micro_batch_size = int(micro_batch_size)
+            tqdm.write(f'Largest micro-batch fitting in memory: {micro_batch_size}\n')
+        else:
+            warnings.warn('micro_batch_size can only be probed on a cuda device. Using batch_size.')
+            micro_batch_size = None
+    micro_batch_size = min(int(micro_batch_size or batch_size), batch_size)
+    # every optimizer step must see exactly batch_size samples, so micro_batch_size is rounded down to a divisor of it
+    while batch_size % micro_batch_size:
+        micro_batch_size -= 1
+    accumulation_steps = batch_size // micro_batch_size
+    if accumulation_steps > 1:
+        tqdm.write(f'Accumulating gradients over {accumulation_steps} micro-batches of {micro_batch_size} samples '
+                   f'(effective batch of {accumulation_steps * micro_batch_size} samples per optimizer step)\n')
+        trn_dataloader, val_dataloader, tst_dataloader = create_dataloader(data_path=data_path,
+                                                                           batch_size=micro_batch_size,
+                                                                           task=task,
+                                                                           num_devices=num_devices,
+                                                                           params=params,
+                                                                           samples_folder=samples_folder,
+                                                                           device=device)
+
+    # flips and rotations of whole batches on the device, if augmentation.on_device is True
+    augmentation = aug.batch_augmentation(params)
+
     filename = os.path.join(output_path, 'checkpoint.pth.tar')
 
     # VISUALIZATION: generate pngs of inputs, labels and outputs
@@ -329,11 +472,11 @@ def main(params, config_path):
         assert isinstance(vis_batch_range, list) and len(vis_batch_range) == 3 and all(isinstance(x, int) for x in vis_batch_range)
         vis_at_init = get_key_def('vis_at_init', params['visualization'], False)
         vis_at_init_dataset = get_key_def('vis_at_init_dataset', params['visualization'], 'val')
-        if vis_at_init:
+        if vis_at_init and is_main_process():
             tqdm.write(f'Visualizing initialized model on batch range {vis_batch_range} from {vis_at_init_dataset} dataset...\n')
             vis_from_dataloader(params=params,
                                 eval_loader=val_dataloader if vis_at_init_dataset == 'val' else tst_dataloader,
-                                model=model,
+                                model=model.module if distributed else model,
                                 ep_num=0,
                                 output_path=output_path,
                                 dataset=vis_at_init_dataset,
@@ -342,6 +485,8 @@ def main(params, config_path):
 
     for epoch in range(0, params['training']['num_epochs']):
         print(f'\nEpoch {epoch}/{params["training"]["num_epochs"] - 1}\n{"-" * 20}')
+        if distributed:
+            trn_dataloader.sampler.set_epoch(epoch)
 
         trn_report = train(train_loader=trn_dataloader,
                            model=model,
@@ -353,10 +498,17 @@ def main(params, config_path):
                            task=task,
                            ep_idx=epoch,
                            progress_log=progress_log,
+                           run_logger=run_logger,
+                           sync_every=sync_every,
                            vis_params=params,
                            device=device,
+                           amp_dtype=amp_dtype,
+                           scaler=scaler,
+                           accumulation_steps=accumulation_steps,
+                           augmentation=augmentation,
                            debug=debug)
-        trn_log.add_values(trn_report, epoch, ignore=['precision', 'recall', 'fscore', 'iou'])
+        if is_main_process():
+            trn_log.add_values(trn_report, epoch, ignore=['precision', 'recall', 'fscore', 'iou'])
 
 
         val_report = evaluation(eval_loader=val_dataloader,
@@ -367,27 +519,33 @@ def main(params, config_path):
                                 task=task,
                                 ep_idx=epoch,
                                 progress_log=progress_log,
+                                run_logger=run_logger,
+                                sync_every=sync_every,
                                 vis_params=params,
                                 batch_metrics=params['training']['batch_metrics'],
                                 dataset='val',
                                 device=device,
+                                amp_dtype=amp_dtype,
                                 debug=debug)
+        # val_loss is reduced over all processes, so they all take the same decisions below
         val_loss = val_report['loss'].avg
-        if params['training']['batch_metrics'] is not None:
-            val_log.add_values(val_report, epoch)
-        else:
-            val_log.add_values(val_report, epoch, ignore=['precision', 'recall', 'fscore', 'iou'])
+        if is_main_process():
+            if params['training']['batch_metrics'] is not None:
+                val_log.add_values(val_report, epoch)
+            else:
+                val_log.add_values(val_report, epoch, ignore=['precision', 'recall', 'fscore', 'iou'])
 
         if val_loss < best_loss:
-            tqdm.write("save checkpoint\n")
             best_loss = val_loss
-            # More info: https://pytorch.org/tutorials/beginner/saving_loading_models.html#saving-torch-nn-dataparallel-models
-            state_dict = model.module.state_dict() if num_devices > 1 else model.state_dict()
-            torch.save({'epoch': epoch,
-                        'arch': model_name,
-                        'model': state_dict,
-                        'best_loss': best_loss,
-                        'optimizer': optimizer.state_dict()}, filename)
+            if is_main_process():
+                tqdm.write("save checkpoint\n")
+                # More info: https://pytorch.org/tutorials/beginner/saving_loading_models.html#saving-torch-nn-dataparallel-models
+                state_dict = model.module.state_dict() if num_devices > 1 or distributed else model.state_dict()
+                torch.save({'epoch': epoch,
+                            'arch': model_name,
+                            'model': state_dict,
+                            'best_loss': best_loss,
+                            'optimizer': optimizer.state_dict()}, filename)
 
             if bucket_name:
                 bucket_filename = os.path.join(bucket_output_path, 'checkpoint.pth.tar')
@@ -397,12 +555,13 @@ def main(params, config_path):
             vis_at_checkpoint = get_key_def('vis_at_checkpoint', params['visualization'], False)
             ep_vis_min_thresh = get_key_def('vis_at_ckpt_min_ep_diff', params['visualization'], 4)
             vis_at_ckpt_dataset = get_key_def('vis_at_ckpt_dataset', params['visualization'], 'val')
-            if vis_batch_range is not None and vis_at_checkpoint and epoch - last_vis_epoch >= ep_vis_min_thresh:
+            if vis_batch_range is not None and vis_at_checkpoint and epoch - last_vis_epoch >= ep_vis_min_thresh \
+                    and is_main_process():
                 if last_vis_epoch == 0:
                     tqdm.write(f'Visualizing with {vis_at_ckpt_dataset} dataset samples on checkpointed model for batches {vis_batch_range}')
                 vis_from_dataloader(params=params,
                                     eval_loader=val_dataloader if vis_at_ckpt_dataset == 'val' else tst_dataloader,
-                                    model=model,
+                                    model=model.module if distributed else model,
                                     ep_num=epoch+1,
                                     output_path=output_path,
                                     dataset=vis_at_ckpt_dataset,
@@ -418,8 +577,12 @@ def main(params, config_path):
 
     # load checkpoint model and evaluate it on test dataset.
     if int(params['training']['num_epochs']) > 0:    #if num_epochs is set to 0, model is loaded to evaluate on test set
+        barrier()  # wait for the main process to write the checkpoint
         checkpoint = load_checkpoint(filename)
-        model, _ = load_from_checkpoint(checkpoint, model)
+        if distributed:
+            load_from_checkpoint(checkpoint, model.module)
+        else:
+            model, _ = load_from_checkpoint(checkpoint, model)
 
     if tst_dataloader:
         tst_report = evaluation(eval_loader=tst_dataloader,
@@ -430,22 +593,28 @@ def main(params, config_path):
                                 task=task,
                                 ep_idx=params['training']['num_epochs'],
                                 progress_log=progress_log,
+                                run_logger=run_logger,
+                                sync_every=sync_every,
                                 vis_params=params,
                                 batch_metrics=params['training']['batch_metrics'],
                                 dataset='tst',
-                                device=device)
-        tst_log.add_values(tst_report, params['training']['num_epochs'])
+                                device=device,
+                                amp_dtype=amp_dtype)
+        if is_main_process():
+            tst_log.add_values(tst_report, params['training']['num_epochs'])
 
         if bucket_name:
             bucket_filename = os.path.join(bucket_output_path, 'last_epoch.pth.tar')
             bucket.upload_file("output.txt", os.path.join(bucket_output_path, f"Logs/{now}_output.txt"))
             bucket.upload_file(filename, bucket_filename)
 
+    run_logger.close()
     time_elapsed = time.time() - since
     print('Training complete in {:.0f}m {:.0f}s'.format(time_elapsed // 60, time_elapsed % 60))
+    cleanup()
 
 
-def train(train_loader, model, criterion, optimizer, scheduler, num_classes, batch_size, task, ep_idx, progress_log, vis_params, device, debug=False):
+def train(train_loader, model, criterion, optimizer, scheduler, num_classes, batch_size, task, ep_idx, progress_log, vis_params, device, amp_dtype=None, scaler=None, accumulation_steps=1, augmentation=None, run_logger=None, sync_every=50, debug=False):
     """
     Train the model and return the metrics of the training epoch
     :param train_loader: training data loader
@@ -461,30 +630,48 @@ def train(train_loader, model, criterion, optimizer, scheduler, num_classes, bat
     :param vis_params: (dict) Parameters found in the yaml config file. Named vis_params because they are only used for
                         visualization functions.
     :param device: device used by pytorch (cpu ou cuda)
+    :param amp_dtype: (torch.dtype) dtype of the automatic mixed precision forward pass. If None, full fp32 precision
+    :param scaler: (torch.cuda.amp.GradScaler) gradient scaler, for fp16 mixed precision
+    :param accumulation_steps: (int) number of micro-batches whose gradients are accumulated before each optimizer step
+    :param augmentation: (BatchAugmentation) augmentation applied on each batch on the device, if any
+    :param run_logger: (RunLogger) logging backend of the run. If None, one is opened on progress_log
+    :param sync_every: (int) the loss and debug statistics are read from the device every sync_every batches
     :return: Updated training loss
     """
     model.train()
     train_metrics = create_metrics_dict(num_classes)
+    loss_meter = LossMeter(device=device)
+    scaler = torch.cuda.amp.GradScaler(enabled=False) if scaler is None else scaler
+    optimizer.zero_grad()
+    logger = RunLogger(progress_log) if run_logger is None else run_logger
     vis_at_train = get_key_def('vis_at_train', vis_params['visualization'], False)
     vis_batch_range = get_key_def('vis_batch_range', vis_params['visualization'], None)
     min_vis_batch, max_vis_batch, increment = vis_batch_range
 
     with tqdm(train_loader, desc=f'Iterating train batches with {device.type}') as _tqdm:
         for batch_index, data in enumerate(_tqdm):
-            progress_log.open('a', buffering=1).write(tsv_line(ep_idx, 'trn', batch_index, len(train_loader), time.time()))
+            logger.progress_line(ep_idx, 'trn', batch_index, len(train_loader), time.time())
 
             inputs = data['sat_img'].to(device)
             labels = data['map_img'].to(device)
+            if augmentation is not None:
+                inputs, labels = augmentation(inputs, labels)
+
+            # optimizer step after the last micro-batch of each group, or of the epoch
+            step = (batch_index + 1) % accumulation_steps == 0 or batch_index + 1 == len(train_loader)
+            # gradients are only synchronized between processes on the micro-batch of the optimizer step
+            no_sync = model.no_sync if isinstance(model, DistributedDataParallel) and not step else contextlib.nullcontext
 
             # forward
-            optimizer.zero_grad()
-            outputs = model(inputs)
+            with no_sync(), torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                outputs = model(inputs)
             # added for torchvision models that output an OrderedDict with outputs in 'out' key.
             # More info: https://pytorch.org/hub/pytorch_vision_deeplabv3_resnet101/
             if isinstance(outputs, OrderedDict):
                 outputs = outputs['out']
 
-            if vis_batch_range is not None and vis_at_train and batch_index in range(min_vis_batch, max_vis_batch, increment):
+            if vis_batch_range is not None and vis_at_train and batch_index in range(min_vis_batch, max_vis_batch, increment) \
+                    and is_main_process():
                     vis_path = progress_log.parent.joinpath('visualization')
                     if ep_idx == 0:
                         tqdm.write(f'Visualizing on train outputs for batches in range {vis_batch_range}. All images will be saved to {vis_path}\n')
@@ -497,28 +684,42 @@ def train(train_loader, model, criterion, optimizer, scheduler, num_classes, bat
 
             loss = criterion(outputs, labels)
 
-            train_metrics['loss'].update(loss.item(), batch_size)
+            loss_meter.update(loss, inputs.shape[0])
 
-            if device.type == 'cuda' and debug:
+            if (batch_index + 1) % sync_every == 0 and device.type == 'cuda' and debug:
                 res, mem = gpu_stats(device=device.index)
-                _tqdm.set_postfix(OrderedDict(trn_loss=f'{train_metrics["loss"].val:.2f}',
+                _tqdm.set_postfix(OrderedDict(trn_loss=f'{loss_meter.average():.2f}',
                                               gpu_perc=f'{res.gpu} %',
                                               gpu_RAM=f'{mem.used / (1024 ** 2):.0f}/{mem.total / (1024 ** 2):.0f} MiB',
                                               lr=optimizer.param_groups[0]['lr'],
-                                              img=data['sat_img'].numpy().shape[1:],
-                                              smpl=data['map_img'].numpy().shape,
+                                              img=tuple(data['sat_img'].shape[1:]),
+                                              smpl=tuple(data['map_img'].shape),
                                               bs=batch_size,
                                               out_vals=np.unique(outputs[0].argmax(dim=0).detach().cpu().numpy())))
-
-            loss.backward()
-            optimizer.step()
+            elif (batch_index + 1) % sync_every == 0:
+                _tqdm.set_postfix(OrderedDict(trn_loss=f'{loss_meter.average():.2f}'))
+
+            # micro-batches have the same size (drop_last), so the mean over the accumulated batch is the mean of the
+            # micro-batch losses. The last group of the epoch may hold fewer micro-batches.
+            group_size = min(accumulation_steps,
+                             len(train_loader) - batch_index // accumulation_steps * accumulation_steps)
+            with no_sync():
+                scaler.scale(loss / group_size).backward()
+            if step:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
 
     scheduler.step()
+    if run_logger is None:
+        logger.close()
+    train_metrics['loss'].update(loss_meter.all_reduce().average())
     print(f'Training Loss: {train_metrics["loss"].avg:.4f}')
+    print_timings(train_loader, 'trn')
     return train_metrics
 
 
-def evaluation(eval_loader, model, criterion, num_classes, batch_size, task, ep_idx, progress_log, vis_params, batch_metrics=None, dataset='val', device=None, debug=False):
+def evaluation(eval_loader, model, criterion, num_classes, batch_size, task, ep_idx, progress_log, vis_params, batch_metrics=None, dataset='val', device=None, amp_dtype=None, run_logger=None, sync_every=50, debug=False):
     """
     Evaluate the model and return the updated metrics
     :param eval_loader: data loader
@@ -532,9 +733,16 @@ def evaluation(eval_loader, model, criterion, num_classes, batch_size, task, ep_
     :param batch_metrics: (int) Metrics computed every (int) batches. If left blank, will not perform metrics.
     :param dataset: (str) 'val or 'tst'
     :param device: device used by pytorch (cpu ou cuda)
+    :param amp_dtype: (torch.dtype) dtype of the automatic mixed precision forward pass. If None, full fp32 precision
+    :param run_logger: (RunLogger) logging backend of the run. If None, one is opened on progress_log
+    :param sync_every: (int) the loss and debug statistics are read from the device every sync_every batches
     :return: (dict) eval_metrics
     """
     eval_metrics = create_metrics_dict(num_classes)
+    confusion_matrix = ConfusionMatrix(num_classes, ignore_index=get_key_def("ignore_index", params["training"], None),
+                                       device=device)
+    loss_meter = LossMeter(device=device)
+    logger = RunLogger(progress_log) if run_logger is None else run_logger
     model.eval()
     for m in model.modules():
         if isinstance(m, nn.BatchNorm2d):
@@ -545,18 +753,20 @@ def evaluation(eval_loader, model, criterion, num_classes, batch_size, task, ep_
 
     with tqdm(eval_loader, dynamic_ncols=True, desc=f'Iterating {dataset} batches with {device.type}') as _tqdm:
         for batch_index, data in enumerate(_tqdm):
-            progress_log.open('a', buffering=1).write(tsv_line(ep_idx, dataset, batch_index, len(eval_loader), time.time()))
+            logger.progress_line(ep_idx, dataset, batch_index, len(eval_loader), time.time())
 
             with torch.no_grad():
                 inputs = data['sat_img'].to(device)
                 labels = data['map_img'].to(device)
                 labels_flatten = flatten_labels(labels)
 
-                outputs = model(inputs)
+                with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                    outputs = model(inputs)
                 if isinstance(outputs, OrderedDict):
                     outputs = outputs['out']
 
-                if vis_batch_range is not None and vis_at_eval and batch_index in range(min_vis_batch, max_vis_batch, increment):
+                if vis_batch_range is not None and vis_at_eval and batch_index in range(min_vis_batch, max_vis_batch, increment) \
+                        and is_main_process():
                         vis_path = progress_log.parent.joinpath('visualization')
                         if ep_idx == 0 and batch_index == min_vis_batch:
                             tqdm.write(f'Visualizing on {dataset} outputs for batches in range {vis_batch_range}. All '
@@ -572,33 +782,44 @@ def evaluation(eval_loader, model, criterion, num_classes, batch_size, task, ep_
 
                 loss = criterion(outputs, labels)
 
-                eval_metrics['loss'].update(loss.item(), batch_size)
+                loss_meter.update(loss, inputs.shape[0])
 
                 if (dataset == 'val') and (batch_metrics is not None):
-                    # Compute metrics every n batches. Time consuming.
+                    # Accumulate metrics every n batches.
                     assert batch_metrics <= len(_tqdm), f"Batch_metrics ({batch_metrics} is smaller than batch size " \
                         f"{len(_tqdm)}. Metrics in validation loop won't be computed"
                     if (batch_index+1) % batch_metrics == 0:   # +1 to skip val loop at very beginning
                         a, segmentation = torch.max(outputs_flatten, dim=1)
-                        eval_metrics = report_classification(segmentation, labels_flatten, batch_size, eval_metrics,
-                                                             ignore_index=get_key_def("ignore_index", params["training"], None))
+                        confusion_matrix.update(segmentation, labels_flatten)
                 elif dataset == 'tst':
                     a, segmentation = torch.max(outputs_flatten, dim=1)
-                    eval_metrics = report_classification(segmentation, labels_flatten, batch_size, eval_metrics,
-                                                         ignore_index=get_key_def("ignore_index", params["training"], None))
+                    confusion_matrix.update(segmentation, labels_flatten)
 
-                _tqdm.set_postfix(OrderedDict(dataset=dataset, loss=f'{eval_metrics["loss"].avg:.4f}'))
+                if (batch_index + 1) % sync_every == 0:
+                    _tqdm.set_postfix(OrderedDict(dataset=dataset, loss=f'{loss_meter.average():.4f}'))
 
-                if debug and device.type == 'cuda':
+                if debug and device.type == 'cuda' and (batch_index + 1) % sync_every == 0:
                     res, mem = gpu_stats(device=device.index)
                     _tqdm.set_postfix(OrderedDict(device=device, gpu_perc=f'{res.gpu} %',
                                                   gpu_RAM=f'{mem.used/(1024**2):.0f}/{mem.total/(1024**2):.0f} MiB'))
 
+    if run_logger is None:
+        logger.close()
+
+    # sum the partial states of all processes, if evaluation is sharded
+    loss_meter.all_reduce()
+    confusion_matrix.all_reduce()
+    eval_metrics['loss'].update(loss_meter.average())
+    if (dataset == 'val' and batch_metrics is not None) or dataset == 'tst':
+        eval_metrics = report_classification(confusion_matrix, eval_metrics)
+
     print(f"{dataset} Loss: {eval_metrics['loss'].avg}")
+    print_timings(eval_loader, dataset)
     if batch_metrics is not None:
         print(f"{dataset} precision: {eval_metrics['precision'].avg}")
         print(f"{dataset} recall: {eval_metrics['recall'].avg}")
         print(f"{dataset} fscore: {eval_metrics['fscore'].avg}")
+        print(f"{dataset} iou: {eval_metrics['iou'].avg}")
 
     return eval_metrics
 
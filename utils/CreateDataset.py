@@ -1,4 +1,6 @@
+import ast
 import collections
+import json
 import os
 import warnings
 
@@ -38,6 +40,65 @@ def create_files_and_datasets(params, samples_folder):
     return hdf5_files
 
 
+def encode_metadata(metadata):
+    """
+    Serializes a metadata record, as stored in the "metadata" dataset of the hdf5 samples files.
+    :param metadata: (dict) metadata record (ex.: as read by read_parameters)
+    :return: (str) JSON string. Values that are not JSON types are stored as strings.
+    """
+    return json.dumps(metadata, default=str)
+
+
+def _parse_legacy_node(node):
+    """Rebuilds a value from the syntax tree of its repr, without evaluating it. Only literals and ordereddict([...])
+    calls (repr of ruamel and collections ordered dicts) are accepted."""
+    if isinstance(node, ast.Call):
+        name = node.func.attr if isinstance(node.func, ast.Attribute) else getattr(node.func, 'id', '')
+        if name.lower() != 'ordereddict' or len(node.args) > 1 or node.keywords:
+            raise ValueError(f'unexpected call to {name} in metadata record')
+        return collections.OrderedDict(_parse_legacy_node(node.args[0]) if node.args else [])
+    if isinstance(node, (ast.List, ast.Tuple)):
+        values = [_parse_legacy_node(element) for element in node.elts]
+        return values if isinstance(node, ast.List) else tuple(values)
+    if isinstance(node, ast.Dict):
+        return {_parse_legacy_node(key): _parse_legacy_node(value) for key, value in zip(node.keys, node.values)}
+    return ast.literal_eval(node)
+
+
+def decode_metadata(record):
+    """
+    Deserializes a metadata record of the "metadata" dataset of an hdf5 samples file.
+    :param record: record as read from the hdf5 file. JSON string, or repr of an ordered dict written by previous
+                   versions (parsed, never evaluated).
+    :return: (collections.OrderedDict) metadata record, or the record as is if it is neither JSON nor an ordered dict
+    """
+    if isinstance(record, np.ndarray) and len(record) == 1:
+        record = record[0]
+    if isinstance(record, bytes):
+        record = record.decode('utf-8')
+    if isinstance(record, str):
+        if record.startswith('{'):
+            return json.loads(record, object_pairs_hook=collections.OrderedDict)
+        if 'ordereddict' in record.lower():
+            return _parse_legacy_node(ast.parse(record, mode='eval').body)
+    return record
+
+
+class MetadataStore(object):
+    """Metadata records of an hdf5 samples file, indexed by meta_idx. Records are only read and decoded when first
+    accessed, then cached, so that opening a dataset does not depend on the number of records."""
+
+    def __init__(self, hdf5_path):
+        self.hdf5_path = hdf5_path
+        self.records = {}
+
+    def __getitem__(self, meta_idx):
+        if meta_idx not in self.records:
+            with h5py.File(self.hdf5_path, "r") as hdf5_file:
+                self.records[meta_idx] = decode_metadata(hdf5_file["metadata"][meta_idx, ...])
+        return self.records[meta_idx]
+
+
 class SegmentationDataset(Dataset):
     """Semantic segmentation dataset based on HDF5 parsing."""
 
@@ -48,21 +109,10 @@ class SegmentationDataset(Dataset):
         self.dataset_type = dataset_type
         self.num_bands = num_bands
         self.transform = transform
-        self.metadata = []
         self.dontcare = dontcare
         self.hdf5_path = os.path.join(self.work_folder, self.dataset_type + "_samples.hdf5")
+        self.metadata = MetadataStore(self.hdf5_path)
         with h5py.File(self.hdf5_path, "r") as hdf5_file:
-            if "metadata" in hdf5_file:
-                for i in range(hdf5_file["metadata"].shape[0]):
-                    metadata = hdf5_file["metadata"][i, ...]
-                    if isinstance(metadata, np.ndarray) and len(metadata) == 1:
-                        metadata = metadata[0]
-                    if isinstance(metadata, str):
-                        if "ordereddict" in metadata:
-                            metadata = metadata.replace("ordereddict", "collections.OrderedDict")
-                        if metadata.startswith("collections.OrderedDict"):
-                            metadata = eval(metadata)
-                    self.metadata.append(metadata)
             if self.max_sample_count is None:
                 self.max_sample_count = hdf5_file["sat_img"].shape[0]
 
@@ -108,27 +158,67 @@ class MetaSegmentationDataset(SegmentationDataset):
         super().__init__(work_folder=work_folder, dataset_type=dataset_type, num_bands=num_bands,
                          max_sample_count=max_sample_count,
                          dontcare=dontcare, transform=transform)
-        assert all([isinstance(m, (dict, collections.OrderedDict)) for m in self.metadata]), \
-            "cannot use provided metadata object type with meta-mapping dataset interface"
+        # metadata records are decoded lazily, so their type is checked when their meta layers are computed
         self.meta_map = meta_map
+        self.meta_layers_cache = {}  # (meta_idx, height, width) -> meta layers
+
+    @staticmethod
+    def get_meta_layers(meta_map, metadata, height, width):
+        """
+        Computes the layers appended to the samples of a metadata record.
+        :param meta_map: (dict) metadata key -> handling mode (one of metadata_handling_modes)
+        :param metadata: (dict) metadata record
+        :param height: (int) height of the samples
+        :param width: (int) width of the samples
+        :return: (np.array) meta layers of shape (height, width, get_meta_layer_count(meta_map)), in meta_map order
+        """
+        assert isinstance(metadata, (dict, collections.OrderedDict)), \
+            "cannot use provided metadata object type with meta-mapping dataset interface"
+        meta_layers = np.empty((height, width, MetaSegmentationDataset.get_meta_layer_count(meta_map)),
+                               dtype=np.float32)
+        layer_idx = 0
+        for meta_key, mode in meta_map.items():
+            meta_val = get_key_recursive(meta_key, metadata)
+            if mode == "const_channel":
+                assert np.isscalar(meta_val), "constant channel-wise assignment requires scalar value"
+                meta_layers[:, :, layer_idx] = meta_val
+                layer_idx += 1
+            elif mode == "scaled_channel":
+                assert np.isscalar(meta_val), "scaled channel-wise coords assignment requires scalar value"
+                layers = models.coordconv.get_coords_map(height, width).numpy() * meta_val
+                meta_layers[:, :, layer_idx:layer_idx + 2] = np.moveaxis(layers, 0, 2)
+                layer_idx += 2
+            # else...
+        return meta_layers
 
     @staticmethod
-    def append_meta_layers(tensor, meta_map, metadata):
+    def append_meta_layers(tensor, meta_map, metadata, meta_layers=None):
+        """
+        Appends the meta layers of a metadata record to an image, in a single preallocated output array.
+        :param tensor: (np.array) image of shape (height, width, bands)
+        :param meta_map: (dict) metadata key -> handling mode (one of metadata_handling_modes)
+        :param metadata: (dict) metadata record of the image
+        :param meta_layers: (np.array) meta layers of the record, as returned by get_meta_layers. Computed if None or
+                            of another size than the image.
+        :return: (np.array) image with the meta layers appended, of the same dtype
+        """
         if meta_map:
-            assert isinstance(metadata, (dict, collections.OrderedDict)), "unexpected metadata type"
-            for meta_key, mode in meta_map.items():
-                meta_val = get_key_recursive(meta_key, metadata)
-                if mode == "const_channel":
-                    assert np.isscalar(meta_val), "constant channel-wise assignment requires scalar value"
-                    layer = np.full(tensor.shape[0:2], meta_val, dtype=np.float32)
-                    tensor = np.insert(tensor, tensor.shape[2], layer, axis=2)
-                elif mode == "scaled_channel":
-                    assert np.isscalar(meta_val), "scaled channel-wise coords assignment requires scalar value"
-                    layers = models.coordconv.get_coords_map(tensor.shape[0], tensor.shape[1]) * meta_val
-                    tensor = np.insert(tensor, tensor.shape[2], layers, axis=2)
-                # else...
+            if meta_layers is None or meta_layers.shape[0:2] != tensor.shape[0:2]:
+                meta_layers = MetaSegmentationDataset.get_meta_layers(meta_map, metadata, *tensor.shape[0:2])
+            num_bands = tensor.shape[2]
+            output = np.empty((*tensor.shape[0:2], num_bands + meta_layers.shape[2]), dtype=tensor.dtype)
+            output[:, :, :num_bands] = tensor
+            output[:, :, num_bands:] = meta_layers
+            return output
         return tensor
 
+    def cached_meta_layers(self, meta_idx, height, width):
+        """Meta layers of a metadata record, computed once per record and sample size"""
+        key = (meta_idx, height, width)
+        if key not in self.meta_layers_cache:
+            self.meta_layers_cache[key] = self.get_meta_layers(self.meta_map, self.metadata[meta_idx], height, width)
+        return self.meta_layers_cache[key]
+
     @staticmethod
     def get_meta_layer_count(meta_map):
         meta_layers = 0
@@ -150,7 +240,8 @@ class MetaSegmentationDataset(SegmentationDataset):
             map_img = self._remap_labels(hdf5_file["map_img"][index, ...])
             meta_idx = int(hdf5_file["meta_idx"][index]) if "meta_idx" in hdf5_file else -1
             assert meta_idx != -1, f"metadata unvailable in sample #{index}"
-            sat_img = self.append_meta_layers(sat_img, self.meta_map, self.metadata[meta_idx])
+            meta_layers = self.cached_meta_layers(meta_idx, *sat_img.shape[0:2]) if self.meta_map else None
+            sat_img = self.append_meta_layers(sat_img, self.meta_map, self.metadata[meta_idx], meta_layers)
         sample = {"sat_img": sat_img, "map_img": map_img, "metadata": self.metadata[meta_idx]}
         if self.transform:
             sample = self.transform(sample)
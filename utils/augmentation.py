@@ -6,8 +6,12 @@ import torch
 # import torch should be first. Unclear issue, mentioned here: https://github.com/pytorch/pytorch/issues/2083
 import random
 import numpy as np
+import torch.nn.functional as F
 from skimage import transform
 from torchvision import transforms
+from torch.utils.data.dataloader import default_collate
+
+from utils.utils import get_key_def
 
 
 def compose_transforms(params, dataset):
@@ -18,15 +22,28 @@ def compose_transforms(params, dataset):
     :return: (obj) PyTorch's compose object of the transformations to be applied.
     """
     lst_trans = []
-    if dataset == 'trn':
-        if params['training']['augmentation']['hflip_prob']:
-            lst_trans.append(HorizontalFlip(prob=params['training']['augmentation']['hflip_prob']))
+    # flips and rotations are applied on whole batches by BatchAugmentation instead, if on_device is True
+    on_device = get_key_def('on_device', params['training']['augmentation'], False)
+    hflip_prob = params['training']['augmentation']['hflip_prob'] if dataset == 'trn' and not on_device else None
+    normalize = params['training']['normalization']['mean'] and params['training']['normalization']['std']
 
+    # rotation first, since flip and random rotation commute (the rotation angle is symmetric)
+    if dataset == 'trn' and not on_device:
         if params['training']['augmentation']['rotate_limit'] and params['training']['augmentation']['rotate_prob']:
             lst_trans.append(RandomRotationTarget(limit=params['training']['augmentation']['rotate_limit'],
                                                   prob=params['training']['augmentation']['rotate_prob']))
 
-    if params['training']['normalization']['mean'] and params['training']['normalization']['std']:
+    if get_key_def('fused_transform', params['training']['augmentation'], True):
+        lst_trans.append(FusedTransform(params['global']['num_classes'],
+                                        mean=params['training']['normalization']['mean'] if normalize else None,
+                                        std=params['training']['normalization']['std'] if normalize else None,
+                                        hflip_prob=hflip_prob))
+        return transforms.Compose(lst_trans)
+
+    if hflip_prob:
+        lst_trans.append(HorizontalFlip(prob=hflip_prob))
+
+    if normalize:
         lst_trans.append(Normalize(mean=params['training']['normalization']['mean'],
                                    std=params['training']['normalization']['std']))
 
@@ -34,6 +51,66 @@ def compose_transforms(params, dataset):
     return transforms.Compose(lst_trans)
 
 
+def collate_samples(batch):
+    """Collate function of the segmentation dataloaders. References are kept in int16 by FusedTransform until they
+    are batched, then converted to int64 as expected by the losses."""
+    batch = default_collate(batch)
+    batch['map_img'] = batch['map_img'].long()
+    return batch
+
+
+def batch_augmentation(params):
+    """
+    Function to create the augmentation applied on whole training batches on the training device.
+    :param params: (dict) Parameters found in the yaml config file
+    :return: (BatchAugmentation) augmentation to apply on each training batch, or None if augmentation.on_device is
+             False or if there is no flip nor rotation to apply
+    """
+    augmentation = params['training']['augmentation']
+    if not get_key_def('on_device', augmentation, False):
+        return None
+    hflip_prob = get_key_def('hflip_prob', augmentation, None) or 0
+    rotate_limit = get_key_def('rotate_limit', augmentation, None) or 0
+    rotate_prob = get_key_def('rotate_prob', augmentation, None) or 0
+    if not hflip_prob and not (rotate_limit and rotate_prob):
+        return None
+    return BatchAugmentation(hflip_prob=hflip_prob, rotate_limit=rotate_limit, rotate_prob=rotate_prob)
+
+
+class BatchAugmentation(object):
+    """Flip horizontally and rotate a whole batch of images and targets, on their device, with a probability drawn
+    independently for each sample. Images are interpolated bilinearly and targets with nearest neighbour, so that class
+    ids are preserved. Pixels rotated in from outside the sample are set to 0. Samples are expected to be square."""
+    def __init__(self, hflip_prob=0, rotate_limit=0, rotate_prob=0):
+        self.hflip_prob = hflip_prob
+        self.rotate_limit = rotate_limit
+        self.rotate_prob = rotate_prob
+
+    def __call__(self, sat_img, map_img):
+        """
+        :param sat_img: (tensor) images of shape (N, C, H, W)
+        :param map_img: (tensor) targets of shape (N, H, W)
+        :return: (tensors) augmented images and targets, same shapes and dtypes
+        """
+        num_samples = sat_img.shape[0]
+        device = sat_img.device
+        # x axis scale of -1 to flip, rotation matrix otherwise. Output pixels sample the input at theta @ (x, y, 1).
+        flip = 1. - 2. * (torch.rand(num_samples, device=device) < self.hflip_prob).float()
+        rotate = (torch.rand(num_samples, device=device) < self.rotate_prob).float()
+        angle = torch.empty(num_samples, device=device).uniform_(-self.rotate_limit, self.rotate_limit) * rotate
+        cos, sin = torch.cos(torch.deg2rad(angle)), torch.sin(torch.deg2rad(angle))
+        zeros = torch.zeros_like(cos)
+        theta = torch.stack([torch.stack([cos * flip, -sin, zeros], dim=1),
+                             torch.stack([sin * flip, cos, zeros], dim=1)], dim=1)
+
+        grid = F.affine_grid(theta, list(sat_img.shape), align_corners=False)
+        augmented_img = F.grid_sample(sat_img.float(), grid, mode='bilinear', padding_mode='zeros',
+                                      align_corners=False).to(sat_img.dtype)
+        augmented_map = F.grid_sample(map_img.unsqueeze(1).float(), grid, mode='nearest', padding_mode='zeros',
+                                      align_corners=False).squeeze(1).round().to(map_img.dtype)
+        return augmented_img, augmented_map
+
+
 class RandomRotationTarget(object):
     """Rotate the image and target randomly."""
     def __init__(self, limit, prob):
@@ -79,6 +156,38 @@ class Normalize(object):
             return sample
 
 
+class FusedTransform(object):
+    """Flip (with a probability), normalize and convert a sample to tensors in a single pass. The image is written once,
+    straight from the (flipped) input into its CHW float32 array, with the mean and 1 / std precomputed in float32.
+    The reference stays int16 and is only copied if flipped; see collate_samples. Like Normalize, a single mean or std
+    value applies to every band."""
+    def __init__(self, num_classes, mean=None, std=None, hflip_prob=None):
+        self.num_classes = num_classes
+        self.hflip_prob = hflip_prob
+        self.mean = np.asarray(mean, dtype=np.float32) if mean is not None else None
+        self.inv_std = 1 / np.asarray(std, dtype=np.float32) if std is not None else None
+
+    def __call__(self, sample):
+        sat_img, map_img = sample['sat_img'], sample['map_img']
+        if self.hflip_prob and random.random() < self.hflip_prob:
+            sat_img, map_img = sat_img[:, ::-1, ...], map_img[:, ::-1, ...]
+
+        height, width, num_bands = sat_img.shape
+        chw_img = np.empty((num_bands, height, width), dtype=np.float32)
+        if self.mean is not None:
+            mean, inv_std = np.broadcast_to(self.mean, (num_bands,)), np.broadcast_to(self.inv_std, (num_bands,))
+        for band in range(num_bands):
+            if self.mean is not None:
+                np.subtract(sat_img[..., band], mean[band], out=chw_img[band], casting='unsafe')
+                np.multiply(chw_img[band], inv_std[band], out=chw_img[band])
+            else:
+                np.copyto(chw_img[band], sat_img[..., band], casting='unsafe')
+
+        map_img = np.ascontiguousarray(map_img, dtype=np.int16)  # no copy unless flipped or of another dtype
+        np.copyto(map_img, 0, where=map_img > self.num_classes)
+        return {'sat_img': torch.from_numpy(chw_img), 'map_img': torch.from_numpy(map_img)}
+
+
 class ToTensorTarget(object):
     """Convert ndarrays in sample to Tensors."""
     def __init__(self, num_classes):
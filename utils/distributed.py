@@ -0,0 +1,79 @@
+import os
+
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+def init_distributed(backend='gloo'):
+    """
+    Initializes the default process group if the script was launched with torchrun (or any launcher setting the RANK,
+    WORLD_SIZE, MASTER_ADDR and MASTER_PORT environment variables) with more than one process.
+    :param backend: (str) torch.distributed backend. gloo runs on CPU and GPU, nccl on GPU only
+    :return: (bool) True if running in distributed mode
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend, init_method='env://')
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank():
+    """Rank of the process on its node, as set by torchrun. Used to pick the cuda device of the process."""
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    """Returns the obj of process src on every process. Obj must be picklable."""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+class ShardSampler(Sampler):
+    """
+    Sampler of the samples of one process, in order, for the evaluation of a sharded dataset. Unlike
+    DistributedSampler, the shards are not padded with duplicate samples: each sample is seen by exactly one process,
+    so the sums of the metrics reduced over all processes are the ones of a single process.
+    :param dataset: dataset to shard
+    :param num_replicas: (int) number of processes. If None, the world size
+    :param rank: (int) rank of the process. If None, the rank of the current process
+    """
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        self.dataset = dataset
+        self.num_replicas = get_world_size() if num_replicas is None else num_replicas
+        self.rank = get_rank() if rank is None else rank
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.dataset), self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.dataset), self.num_replicas))
@@ -0,0 +1,112 @@
+import numpy as np
+
+
+def class_histogram(tiles, num_classes, ignore_index=None):
+    """
+    Computes the pixel count of every class for a whole batch of label tiles with a single bincount. Labels are offset
+    so that negative values (e.g. an ignore_index of -1) get their own column instead of breaking np.bincount.
+    :param tiles: (numpy array) label tiles, stacked on the first axis (e.g. shape (N, H, W))
+    :param num_classes: (int) number of classes, i.e. labels expected in [0, num_classes)
+    :param ignore_index: (int) optional label that must have a column even if absent from the tiles
+    :return: (numpy array) counts of shape (N, len(labels)), (numpy array) labels matching the columns of counts
+    """
+    num_tiles = tiles.shape[0]
+    flat = np.asarray(tiles).reshape(num_tiles, -1)
+    low, high = 0, num_classes - 1
+    if flat.size:
+        low, high = min(low, int(flat.min())), max(high, int(flat.max()))
+    if ignore_index is not None:
+        low, high = min(low, ignore_index), max(high, ignore_index)
+    num_bins = high - low + 1
+
+    offsets = np.arange(num_tiles, dtype=np.int64)[:, np.newaxis] * num_bins - low
+    counts = np.bincount((flat + offsets).ravel(), minlength=num_tiles * num_bins)
+    return counts.reshape(num_tiles, num_bins), np.arange(low, high + 1)
+
+
+def class_columns(counts, labels, classes):
+    """
+    Gathers the count columns of the requested classes. Classes absent from labels get a count of zero.
+    :param counts: (numpy array) counts as returned by class_histogram()
+    :param labels: (numpy array) labels as returned by class_histogram()
+    :param classes: (list of int) classes to gather
+    :return: (numpy array) counts of shape (N, len(classes))
+    """
+    cols = np.asarray(classes, dtype=np.int64) - labels[0]
+    valid = (cols >= 0) & (cols < len(labels))
+    gathered = np.zeros((counts.shape[0], len(cols)), dtype=counts.dtype)
+    gathered[:, valid] = counts[:, cols[valid]]
+    return gathered
+
+
+def class_percentages(counts, labels, classes, sample_total=None):
+    """
+    Proportion (%) of the requested classes in every tile, rounded to one decimal.
+    :param counts: (numpy array) counts as returned by class_histogram()
+    :param labels: (numpy array) labels as returned by class_histogram()
+    :param classes: (list of int) classes to compute the proportion for
+    :param sample_total: (int) number of pixels in a tile. Default: sum of the counts of each tile
+    :return: (numpy array) proportions of shape (N, len(classes))
+    """
+    if sample_total is None:
+        sample_total = np.maximum(counts.sum(axis=1, keepdims=True), 1)
+    return np.round(class_columns(counts, labels, classes) / sample_total * 100, 1)
+
+
+def min_annotated_percent_mask(counts, labels, min_annotated_percent, background=0):
+    """
+    Vectorized min_annotated_percent sampling criterion.
+    :param counts: (numpy array) counts as returned by class_histogram()
+    :param labels: (numpy array) labels as returned by class_histogram()
+    :param min_annotated_percent: (int) Minimum % of non background pixels in a tile to keep it
+    :param background: (int) background label
+    :return: (numpy array of bool) True for the tiles to keep
+    """
+    background_percent = class_percentages(counts, labels, [background])[:, 0]
+    return background_percent <= 100 - min_annotated_percent
+
+
+def class_proportion_mask(counts, labels, thresholds, sample_total=None):
+    """
+    Vectorized class_proportion sampling criterion.
+    :param counts: (numpy array) counts as returned by class_histogram()
+    :param labels: (numpy array) labels as returned by class_histogram()
+    :param thresholds: (dict) minimum proportion (%) of each class, keyed by class
+    :param sample_total: (int) number of pixels in a tile. Default: sum of the counts of each tile
+    :return: (numpy array of bool) True for the tiles where every class reaches its threshold
+    """
+    classes = [int(c) for c in thresholds.keys()]
+    minimums = np.asarray([thresholds[c] for c in thresholds.keys()], dtype=np.float64)
+    return np.all(class_percentages(counts, labels, classes, sample_total) >= minimums, axis=1)
+
+
+def tile_class_counts(label_array, rows, cols, sample_size, labels, fill=0):
+    """
+    Computes the pixel count of every label for many tiles of a 2D label array, using one summed-area table per label.
+    The cost only depends on the image size and not on the number of tiles, so it suits heavily overlapping tiles.
+    Pixels of a tile falling outside the array are counted as the fill label, as if the array was padded with it.
+    :param label_array: (numpy array) 2D label array
+    :param rows: (numpy array) rows of the tile origins (see utils.tiling.tile_origins()), may be negative
+    :param cols: (numpy array) columns of the tile origins (see utils.tiling.tile_origins()), may be negative
+    :param sample_size: (int) size (in pixels) of the tiles
+    :param labels: (list of int) labels to count
+    :param fill: (int) label of the pixels outside the array
+    :return: (numpy array) counts of shape (number of tiles, len(labels))
+    """
+    height, width = label_array.shape
+    rows, cols = np.ravel(rows), np.ravel(cols)
+    row_start, row_end = np.clip(rows, 0, height), np.clip(rows + sample_size, 0, height)
+    col_start, col_end = np.clip(cols, 0, width), np.clip(cols + sample_size, 0, width)
+
+    counts = np.empty((rows.size, len(labels)), dtype=np.int64)
+    # int64 table: sums over rasters of 2 ** 31 pixels or more would wrap around in int32. The column sums (at most
+    # height) fit in int32.
+    table = np.zeros((height + 1, width + 1), dtype=np.int64)
+    for i, label in enumerate(labels):
+        np.cumsum(np.cumsum(label_array == label, axis=0, dtype=np.int32), axis=1, dtype=np.int64,
+                  out=table[1:, 1:])
+        counts[:, i] = (table[row_end, col_end] - table[row_start, col_end]
+                        - table[row_end, col_start] + table[row_start, col_start])
+        if label == fill:
+            counts[:, i] += sample_size ** 2 - (row_end - row_start) * (col_end - col_start)
+    return counts
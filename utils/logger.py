@@ -1,4 +1,7 @@
+import atexit
+import json
 import os
+import time
 import warnings
 
 
@@ -6,8 +9,73 @@ def tsv_line(*args):
     return '\t'.join(map(str, args)) + '\n'
 
 
+class BufferedWriter(object):
+    """Append-only text file kept open for the whole run. Lines are buffered in memory and written every flush_secs
+    seconds or buffer_lines lines, and when the interpreter exits, instead of opening the file for every line."""
+
+    def __init__(self, path, flush_secs=10, buffer_lines=100):
+        self.file = open(path, 'a')
+        self.flush_secs = flush_secs
+        self.buffer_lines = buffer_lines
+        self.lines = []
+        self.last_flush = time.time()
+        atexit.register(self.close)
+
+    def write(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.buffer_lines or time.time() - self.last_flush >= self.flush_secs:
+            self.flush()
+
+    def flush(self):
+        self.file.write(''.join(self.lines))
+        self.file.flush()
+        self.lines = []
+        self.last_flush = time.time()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
+class RunLogger(object):
+    """Logging backend of a training run. Holds the progress log, in the HyperTrainer TSV format, and optionally a
+    structured JSONL log receiving both progress and metric records. Both stay open and buffered for the whole run."""
+
+    progress_header = ('ep_idx', 'phase', 'iter', 'i_p_ep', 'time')
+
+    def __init__(self, progress_path, jsonl_path=None, flush_secs=10, buffer_lines=100):
+        new_file = not os.path.exists(progress_path)
+        self.progress = BufferedWriter(progress_path, flush_secs, buffer_lines)
+        if new_file:
+            self.progress.write(tsv_line(*self.progress_header))
+        self.jsonl = BufferedWriter(jsonl_path, flush_secs, buffer_lines) if jsonl_path else None
+
+    def progress_line(self, ep_idx, phase, iteration, iter_per_epoch, timestamp):
+        self.progress.write(tsv_line(ep_idx, phase, iteration, iter_per_epoch, timestamp))
+        self.record(type='progress', **dict(zip(self.progress_header, (ep_idx, phase, iteration, iter_per_epoch,
+                                                                       timestamp))))
+
+    def record(self, **fields):
+        """Adds a record to the JSONL log, if any"""
+        if self.jsonl is not None:
+            self.jsonl.write(json.dumps(fields, default=str) + '\n')
+
+    def flush(self):
+        self.progress.flush()
+        if self.jsonl is not None:
+            self.jsonl.flush()
+
+    def close(self):
+        self.progress.close()
+        if self.jsonl is not None:
+            self.jsonl.close()
+
+
 class InformationLogger(object):
-    def __init__(self, log_folder, mode):
+    def __init__(self, log_folder, mode, run_logger=None):
+        self.mode = mode
+        self.run_logger = run_logger
         # List of metrics names
         self.metrics = ['loss']
         self.metrics_classwise = []
@@ -15,10 +83,10 @@ class InformationLogger(object):
             self.metrics += ['iou']
             self.metrics_classwise += ['precision', 'recall', 'fscore']
 
-        # Dicts of logs
+        # Dicts of logs, kept open for the whole run
         def open_log(metric_name, fmt_str="metric_{}_{}.log"):
             filename = fmt_str.format(mode, metric_name)
-            return open(os.path.join(log_folder, filename), "a", buffering=1)
+            return BufferedWriter(os.path.join(log_folder, filename))
         self.metric_values = {m: open_log(m) for m in self.metrics}
         self.class_scores = {m: open_log(m, fmt_str="metric_classwise_{}_{}.log") for m in self.metrics_classwise}
         self.averaged_scores = {m: open_log(m, fmt_str="metric_{}_{}_averaged.log") for m in self.metrics_classwise}
@@ -41,6 +109,8 @@ class InformationLogger(object):
                     self.averaged_scores[name].write(tsv_line(epoch, value.avg))
                 else:
                     warnings.warn(f'Unknown metric {name}')
+                    continue
+                self._record(epoch, name, value.avg)
             elif len(tokens) == 2:
                 # Classwise metric; e.g. precision_0, recall_1
                 name, class_idx = tokens
@@ -48,9 +118,24 @@ class InformationLogger(object):
                     continue
                 elif name in self.metrics_classwise:
                     self.class_scores[name].write(tsv_line(epoch, class_idx, value.avg))
+                    self._record(epoch, name, value.avg, class_idx=class_idx)
                 else:
                     warnings.warn(f'Unknown metric {name}')
 
+        # metrics are logged once per epoch; make them visible right away
+        self.flush()
+
+    def _record(self, epoch, metric, value, class_idx=None):
+        if self.run_logger is not None:
+            self.run_logger.record(type='metric', phase=self.mode, epoch=epoch, metric=metric, class_idx=class_idx,
+                                   value=value)
+
+    def flush(self):
+        for log in [*self.metric_values.values(), *self.class_scores.values(), *self.averaged_scores.values()]:
+            log.flush()
+        if self.run_logger is not None:
+            self.run_logger.flush()
+
 
 def save_logs_to_bucket(bucket, bucket_output_path, output_path, now, batch_metrics=None):
     if batch_metrics is not None:
@@ -1,4 +1,4 @@
-from sklearn.metrics import classification_report, jaccard_similarity_score
+import torch
 
 
 def create_metrics_dict(num_classes):
@@ -49,32 +49,114 @@ class AverageMeter(object):
         return self.avg
 
 
-def report_classification(pred, label, batch_size, metrics_dict, ignore_index=-1):
-    """Computes precision, recall and f-score for each class and average of all classes.
-    http://scikit-learn.org/stable/modules/generated/sklearn.metrics.classification_report.html
-    """
-    class_report = classification_report(label.cpu(), pred.cpu(), output_dict=True)
+class TensorAccumulator(object):
+    """Base class of the accumulators whose whole state is a single tensor of sums. Partial states of different
+    batches, shards or processes add up: merge() and all_reduce() give the single-process result if each sample was
+    accumulated by exactly one of them, as with the unpadded val and tst shards (utils.distributed.ShardSampler)."""
 
-    class_score = {}
-    for key, value in class_report.items():
-        if key not in ['micro avg', 'macro avg', 'weighted avg', 'accuracy'] and key != str(ignore_index):
-            class_score[key] = value
+    def __init__(self, state):
+        self.state = state
 
-            metrics_dict['precision_' + key].update(class_score[key]['precision'], batch_size)
-            metrics_dict['recall_' + key].update(class_score[key]['recall'], batch_size)
-            metrics_dict['fscore_' + key].update(class_score[key]['f1-score'], batch_size)
+    def reset(self):
+        self.state.zero_()
 
-    metrics_dict['precision'].update(class_report['weighted avg']['precision'], batch_size)
-    metrics_dict['recall'].update(class_report['weighted avg']['recall'], batch_size)
-    metrics_dict['fscore'].update(class_report['weighted avg']['f1-score'], batch_size)
+    def merge(self, other):
+        """Adds the state of another accumulator of the same kind"""
+        self.state += other.state.to(self.state.device)
+        return self
 
-    return metrics_dict
+    def all_reduce(self):
+        """Sums the state over all the processes of the default process group. No-op outside of distributed runs."""
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(self.state)
+        return self
+
+
+class LossMeter(TensorAccumulator):
+    """Accumulates the sum of the losses (weighted by batch size) and the number of samples, on the device"""
 
+    def __init__(self, device=None):
+        super().__init__(torch.zeros(2, dtype=torch.float64, device=device))
 
-def iou(pred, target, batch_size, metrics_dict):
-    """Calculate the intersection over union (or Jaccard index) between two datasets.
-    The Jaccard distance (or dissimilarity) would be 1-iou.
+    def update(self, loss, batch_size=1):
+        self.state[0] += loss.detach().double() * batch_size
+        self.state[1] += batch_size
+
+    def average(self):
+        total, count = self.state.tolist()
+        return total / count if count else 0.
+
+
+class ConfusionMatrix(TensorAccumulator):
+    """Accumulates a num_classes x num_classes confusion matrix (rows: labels, columns: predictions) on the device of
+    the batches, with a single scatter_add per batch (no host synchronization). Metrics are derived exactly from the
+    whole matrix by compute()."""
+
+    def __init__(self, num_classes, ignore_index=None, device=None):
+        super().__init__(torch.zeros((num_classes, num_classes), dtype=torch.int64, device=device))
+        self.num_classes = num_classes
+        self.ignore_index = ignore_index
+
+    @property
+    def matrix(self):
+        return self.state
+
+    def update(self, pred, label):
+        """Adds a batch of predicted and reference classes, of any (matching) shape"""
+        pred, label = pred.reshape(-1), label.reshape(-1)
+        valid = (label >= 0) & (label < self.num_classes)
+        if self.ignore_index is not None:
+            valid &= label != self.ignore_index
+        # invalid pixels go to an extra bin instead of being masked out, since boolean indexing (like bincount on
+        # cuda) waits for the device to know the size of its output
+        indices = torch.where(valid, label.long() * self.num_classes + pred.long(),
+                              torch.full_like(label, self.num_classes ** 2, dtype=torch.long))
+        counts = torch.zeros(self.num_classes ** 2 + 1, dtype=torch.int64, device=indices.device)
+        counts.scatter_add_(0, indices, torch.ones_like(indices))
+        self.state += counts[:-1].reshape(self.num_classes, self.num_classes).to(self.state.device)
+
+    def compute(self):
+        """
+        Precision, recall, f-score and iou of each class, and their macro and weighted (by support) averages. Averages
+        are taken over the classes found in the references or predictions, except ignore_index.
+        :return: (dict) list of per class values under the metric name, floats under '<name>_macro' and
+                 '<name>_weighted', and list of the classes present under 'present'
+        """
+        matrix = self.matrix.double().cpu()
+        true_pos = matrix.diag()
+        support = matrix.sum(dim=1)
+        predicted = matrix.sum(dim=0)
+        scores = {'precision': true_pos / predicted.clamp(min=1),
+                  'recall': true_pos / support.clamp(min=1),
+                  'fscore': 2 * true_pos / (support + predicted).clamp(min=1),
+                  'iou': true_pos / (support + predicted - true_pos).clamp(min=1)}
+
+        present = (support + predicted) > 0
+        if self.ignore_index is not None and 0 <= self.ignore_index < self.num_classes:
+            present[self.ignore_index] = False
+        weights = support * present / (support * present).sum().clamp(min=1)
+
+        metrics = {'present': present.nonzero().flatten().tolist()}
+        for name, score in scores.items():
+            metrics[name] = score.tolist()
+            metrics[name + '_macro'] = score[present].mean().item() if present.any() else 0.
+            metrics[name + '_weighted'] = (score * weights).sum().item()
+        return metrics
+
+
+def report_classification(confusion_matrix, metrics_dict):
+    """Computes precision, recall and f-score for each class and their weighted average, as well as the mean iou,
+    from the confusion matrix accumulated during the epoch.
     """
-    iou = jaccard_similarity_score(target.cpu(), pred.cpu(), normalize=True)
-    metrics_dict['iou'].update(iou, batch_size)
+    scores = confusion_matrix.compute()
+    for i in scores['present']:
+        metrics_dict['precision_' + str(i)].update(scores['precision'][i])
+        metrics_dict['recall_' + str(i)].update(scores['recall'][i])
+        metrics_dict['fscore_' + str(i)].update(scores['fscore'][i])
+
+    metrics_dict['precision'].update(scores['precision_weighted'])
+    metrics_dict['recall'].update(scores['recall_weighted'])
+    metrics_dict['fscore'].update(scores['fscore_weighted'])
+    metrics_dict['iou'].update(scores['iou_macro'])
+
     return metrics_dict
@@ -0,0 +1,64 @@
+import contextlib
+import time
+
+import torch
+
+
+class DevicePrefetcher(object):
+    """
+    Wraps a DataLoader of dict batches and copies the tensors of batch N+1 to the device while batch N is processed.
+    On cuda, the copies are non-blocking and issued on a side stream, so the DataLoader should use pinned memory.
+    Other attributes (dataset, sampler, batch_size, ...) are those of the wrapped DataLoader.
+
+    The time spent waiting for batches (data loading and copy) and the time spent by the caller between two batches
+    (compute) are accumulated over each iteration in wait_time and compute_time, in seconds. On cuda, compute_time is
+    host time and only includes the kernels the caller waits for (e.g. with loss.item()).
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.wait_time = 0.
+        self.compute_time = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        if name == 'loader':  # not set yet, e.g. while unpickling
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def _preload(self, iterator, stream):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+            return {key: value.to(self.device, non_blocking=True) if torch.is_tensor(value) else value
+                    for key, value in batch.items()}
+
+    def __iter__(self):
+        self.wait_time, self.compute_time = 0., 0.
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        iterator = iter(self.loader)
+
+        start = time.perf_counter()
+        next_batch = self._preload(iterator, stream)
+        while next_batch is not None:
+            if stream is not None:
+                torch.cuda.current_stream(self.device).wait_stream(stream)
+                for value in next_batch.values():
+                    if torch.is_tensor(value):
+                        # memory allocated on the side stream is now used by the current stream
+                        value.record_stream(torch.cuda.current_stream(self.device))
+            batch = next_batch
+            next_batch = self._preload(iterator, stream)
+            self.wait_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            yield batch
+            self.compute_time += time.perf_counter() - start
+            start = time.perf_counter()
+        self.wait_time += time.perf_counter() - start
+
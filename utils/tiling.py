@@ -0,0 +1,92 @@
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+
+def tile_origins(height, width, dist_samples):
+    """
+    Computes the upper-left corner of every tile extracted from an image, in row-major order.
+    :param height: (int) height of the image, in pixels
+    :param width: (int) width of the image, in pixels
+    :param dist_samples: (int) distance (in pixels) between the origins of two consecutive tiles
+    :return: (numpy arrays) rows and columns of the tile origins, both of shape (n_rows, n_cols)
+    """
+    rows = np.arange(0, height, dist_samples)
+    cols = np.arange(0, width, dist_samples)
+    return np.meshgrid(rows, cols, indexing='ij')
+
+
+def tile_view(array, sample_size, dist_samples):
+    """
+    Returns all the tiles of a 2D array as a read-only strided view, in the same order as tile_origins(). The array is
+    zero-padded on the right and bottom so that border tiles have the full sample size.
+    :param array: (numpy array) 2D array to tile (e.g. label raster)
+    :param sample_size: (int) size (in pixels) of the tiles
+    :param dist_samples: (int) distance (in pixels) between the origins of two consecutive tiles
+    :return: (numpy array) view of shape (n_rows, n_cols, sample_size, sample_size)
+    """
+    height, width = array.shape
+    num_rows, num_cols = len(range(0, height, dist_samples)), len(range(0, width, dist_samples))
+    padded = np.pad(array, ((0, sample_size), (0, sample_size)), mode='constant')
+    stride_row, stride_col = padded.strides
+    return np.lib.stride_tricks.as_strided(padded,
+                                           shape=(num_rows, num_cols, sample_size, sample_size),
+                                           strides=(dist_samples * stride_row, dist_samples * stride_col,
+                                                    stride_row, stride_col),
+                                           writeable=False)
+
+
+def image_key(image_path, root=None):
+    """
+    Returns a stable integer key for an image, used to decorrelate the split of different images.
+    :param image_path: (str or Path) path of the image
+    :param root: (str or Path) if the image is inside root, its path relative to root is hashed, so that the key does
+                 not depend on where the data is stored. Otherwise, the whole path is hashed.
+    :return: (int) key of the image
+    """
+    image_path = Path(image_path)
+    if root is not None:
+        try:
+            image_path = image_path.relative_to(root)
+        except ValueError:
+            pass
+    return zlib.crc32(image_path.as_posix().encode('utf-8'))
+
+
+def _splitmix64(x):
+    """Vectorized splitmix64 finalizer. Wraps around on uint64 overflow, by design."""
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def split_tiles(rows, cols, val_percent, seed=0, block_size=None, key=0):
+    """
+    Assigns tiles to the validation dataset by hashing their coordinates. The assignment only depends on the seed,
+    the image key and the tile position, so it is reproducible and does not consume the global random state.
+    :param rows: (numpy array) rows of the tile origins, as returned by tile_origins()
+    :param cols: (numpy array) columns of the tile origins, as returned by tile_origins()
+    :param val_percent: (int) percentage of tiles to send to the validation dataset (0 - 100)
+    :param seed: (int) seed of the split, any integer
+    :param block_size: (int) if set, size (in pixels) of the spatial blocks that are assigned as a whole, so that
+                       overlapping neighbouring tiles end up in the same dataset. Otherwise, each tile is hashed alone.
+    :param key: (int) key of the image the tiles come from (see image_key())
+    :return: (numpy array of bool) True where the tile belongs to the validation dataset, same shape as rows
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    if block_size:
+        rows = rows // block_size
+        cols = cols // block_size
+
+    # any python int (e.g. a negative seed) is taken modulo 2 ** 64, as np.uint64 only accepts [0, 2 ** 64)
+    state = _splitmix64(np.uint64(int(seed) & (2 ** 64 - 1)) ^ _splitmix64(np.uint64(int(key) & (2 ** 64 - 1))))
+    hashed = _splitmix64(state ^ rows.astype(np.uint64))
+    hashed = _splitmix64(hashed ^ cols.astype(np.uint64))
+
+    # 53 most significant bits mapped to a uniform float in [0, 100)
+    draw = (hashed >> np.uint64(11)).astype(np.float64) * (100.0 / 2 ** 53)
+    return draw < val_percent
@@ -2,31 +2,17 @@ import torch
 # import torch should be first. Unclear issue, mentioned here: https://github.com/pytorch/pytorch/issues/2083
 from torch import nn
 import numpy as np
-import rasterio
-import rasterio.features
 import warnings
 import collections
-import fiona
-import matplotlib
 
-matplotlib.use('Agg')
+# rasterio, fiona, pynvml and boto3 are imported by the functions using them, so that importing this module (ex.: for
+# get_key_def) stays fast and does not require optional dependencies
 
 try:
     from ruamel_yaml import YAML
 except ImportError:
     from ruamel.yaml import YAML
 
-try:
-    from pynvml import *
-except ModuleNotFoundError:
-    warnings.warn(f"The python Nvidia management library could not be imported. Ignore if running on CPU only.")
-
-try:
-    import boto3
-except ModuleNotFoundError:
-    warnings.warn('The boto3 library counldn\'t be imported. Ignore if not using AWS s3 buckets', ImportWarning)
-    pass
-
 
 class Interpolate(torch.nn.Module):
     def __init__(self, mode, scale_factor):
@@ -154,6 +140,9 @@ def vector_to_raster(vector_file, input_image, attribute_name, fill=0, target_id
         numpy array of the burned image
     """
 
+    import fiona
+    import rasterio.features
+
     # Extract vector features to burn in the raster image
     with fiona.open(vector_file, 'r') as src:
         lst_vector = [vector for vector in src]
@@ -182,6 +171,7 @@ def vector_to_raster(vector_file, input_image, attribute_name, fill=0, target_id
 def list_s3_subfolders(bucket, data_path):
     list_classes = []
 
+    import boto3  # imported on first use, only needed with AWS s3 buckets
     client = boto3.client('s3')
     result = client.list_objects(Bucket=bucket, Prefix=data_path+'/', Delimiter='/')
     for p in result.get('CommonPrefixes'):
@@ -198,9 +188,13 @@ def get_device_ids(number_requested, max_used_ram=2000, max_used_perc=15, debug=
     """
     lst_free_devices = []
     try:
-        nvmlInit()
+        import pynvml  # imported on first use, only needed with cuda
+    except ModuleNotFoundError as error:
+        raise NameError(f"{error}. Make sure that the NVIDIA management library (pynvml) is installed and running.")
+    try:
+        pynvml.nvmlInit()
         if number_requested > 0:
-            device_count = nvmlDeviceGetCount()
+            device_count = pynvml.nvmlDeviceGetCount()
             for i in range(device_count):
                 res, mem = gpu_stats(i)
                 if debug:
@@ -212,9 +206,7 @@ def get_device_ids(number_requested, max_used_ram=2000, max_used_perc=15, debug=
             if len(lst_free_devices) < number_requested:
                 warnings.warn(f"You requested {number_requested} devices. {device_count} devices are available on this computer and "
                               f"other processes are using {device_count-len(lst_free_devices)} device(s).")
-    except NameError as error:
-        raise NameError(f"{error}. Make sure that the NVIDIA management library (pynvml) is installed and running.")
-    except NVMLError as error:
+    except pynvml.NVMLError as error:
         raise ValueError(f"{error}. Make sure that the latest NVIDIA driver is installed and running.")
 
     return lst_free_devices
@@ -225,10 +217,12 @@ def gpu_stats(device=0):
     Provides GPU utilization (%) and RAM usage
     :return: res.gpu, res.memory
     """
-    nvmlInit()
-    handle = nvmlDeviceGetHandleByIndex(device)
-    res = nvmlDeviceGetUtilizationRates(handle)
-    mem = nvmlDeviceGetMemoryInfo(handle)
+    import pynvml
+
+    pynvml.nvmlInit()
+    handle = pynvml.nvmlDeviceGetHandleByIndex(device)
+    res = pynvml.nvmlDeviceGetUtilizationRates(handle)
+    mem = pynvml.nvmlDeviceGetMemoryInfo(handle)
 
     return res, mem
 
@@ -334,6 +328,8 @@ def create_new_raster_from_base(input_raster, output_raster, write_array):
     else:
         raise ValueError(f'Array with {len(write_array.shape)} dimensions cannot be written by rasterio.')
 
+    import rasterio
+
     with rasterio.open(input_raster, 'r') as src:
         with rasterio.open(output_raster, 'w',
                            driver=src.driver,
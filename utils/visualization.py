@@ -7,12 +7,19 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from PIL import Image
-from matplotlib import pyplot as plt, gridspec, cm, colors
 import csv
 
 from utils.utils import minmax_scale, unnormalize, get_key_def, create_new_raster_from_base
 
 
+def pyplot():
+    """Imports matplotlib's pyplot on first use, with the non interactive Agg backend"""
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+    return plt
+
+
 def grid_vis(input, output, heatmaps_dict, label=None, heatmaps=True):
     """ Create a grid with PIL images and titles
     :param input: (tensor) input array as pytorch tensor, e.g. as returned by dataloader
@@ -29,6 +36,9 @@ def grid_vis(input, output, heatmaps_dict, label=None, heatmaps=True):
     num_tiles = (len(list_imgs_pil) + len(heatmaps_dict))
     height = math.ceil(num_tiles/4)
     width = num_tiles if num_tiles < 4 else 4
+    from matplotlib import gridspec
+
+    plt = pyplot()
     plt.figure(figsize=(width*6, height*6))
     grid_spec = gridspec.GridSpec(height, width)
 
@@ -106,7 +116,7 @@ def vis(params, input, output, vis_path, sample_num=0, label=None, dataset='', e
     if not inference:  # FIXME: function parameters should not come in as different types if inference or not.
         input = input.cpu().permute(1, 2, 0).numpy()  # channels last
         output = F.softmax(output, dim=0)  # Inference output is already softmax
-        output = output.detach().cpu().permute(1, 2, 0).numpy()  # channels last
+        output = output.detach().float().cpu().permute(1, 2, 0).numpy()  # channels last (float: outputs may be bf16)
         if label is not None:
             label = label.cpu()
             if ignore_index < 0: # TODO: test when ignore_index is smaller than 1.
@@ -156,7 +166,7 @@ def vis(params, input, output, vis_path, sample_num=0, label=None, dataset='', e
     elif grid:  # SAVE PIL IMAGES AS GRID
         grid = grid_vis(input_PIL, output_argmax_PIL, heatmaps_dict, label=label_PIL, heatmaps=heatmaps)
         grid.savefig(vis_path.joinpath(f'{dataset}_{sample_num:03d}_ep{ep_num:03d}.png'))
-        plt.close()
+        grid.close()
     else:  # SAVE PIL IMAGES DIRECTLY TO FILE
         if not vis_path.joinpath(f'{dataset}_{sample_num:03d}_satimg.jpg').is_file():
             input_PIL.save(vis_path.joinpath(f'{dataset}_{sample_num:03d}_satimg.jpg'))
@@ -176,6 +186,8 @@ def heatmaps_to_dict(output, classes=[], inference=False, debug=False):
     :param output: softmax tensor
     :return: dictionary where key is value of class and value is numpy array
     '''
+    from matplotlib import cm
+
     heatmaps_dict = {}
     classes = range(output.shape[2]) if len(classes) == 0 else classes
     for i in range(output.shape[2]):  # for each channel (i.e. class) in output
@@ -197,6 +209,8 @@ def colormap_reader(output, colormap_path=None, default_colormap='Set1'):
     :param colormap_path: csv file (with header) containing 3 columns (input grayscale value, classes, html colors (#RRGGBB))
     :return: list of classes and list of html colors to map to grayscale values associated with classes
     """
+    from matplotlib import cm, colors
+
     if colormap_path is not None:
         assert Path(colormap_path).is_file(), f'Could not locate {colormap_path}'
         input_val = []